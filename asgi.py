@@ -0,0 +1,241 @@
+# Copyright 2024 Google LLC
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#  https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Asyncio-native variant of the /ask pipeline. Gemini is called through its async
+# API on the event loop, so one process can hold hundreds of slow LLM calls in
+# flight instead of one per gunicorn thread. Embedding and neighbor lookups still
+# run on the micro-batchers' thread pools and are awaited without blocking the
+# loop; the CPU-bound pipeline steps run on the default to_thread pool. Serve it with:
+#   uvicorn asgi:app --host 0.0.0.0 --port 8080
+
+import asyncio
+import logging
+from quart import Quart, Response, request, jsonify, render_template
+from quart_cors import cors
+from metrics import CONTENT_TYPE_LATEST, generate_latest, stage_timer, track_request, tracked_stream
+from deadlines import DeadlineExceeded, deadline_scope, set_deadline, stage_timeout, wait_async
+from breaker import CircuitOpenError
+
+from pipeline import (
+    EMBED_TIMEOUT,
+    EMBEDDING_MODEL_NAME,
+    FIND_NEIGHBORS_TIMEOUT,
+    REQUEST_DEADLINE,
+    advance,
+    answer_batch,
+    answer_cache,
+    clients,
+    complete_answer,
+    embedding_batcher,
+    embedding_cache,
+    generation_breaker,
+    get_data_from_bucket,
+    get_filters,
+    get_session,
+    health_status,
+    neighbor_batcher,
+    parse_batch_request,
+    prompt_steps,
+    sse_event,
+    start,
+    stats_report,
+    timeout_response,
+    unavailable_response,
+)
+
+# Configure logging; the WSGI/ASGI servers leave the root logger at WARNING
+logging.basicConfig(level=logging.INFO)
+
+app = cors(Quart(__name__))
+
+
+async def embed_question(question):
+    """Return the query embedding for a question, using the embedding cache."""
+    with stage_timer('embed'):
+        # The cache may have to read its sqlite tier
+        vector = await asyncio.to_thread(embedding_cache.get, question, EMBEDDING_MODEL_NAME)
+        if vector is None:
+            # Concurrent questions share one batched embedding call
+            vector = await wait_async(embedding_batcher.submit_future(question), 'embed', EMBED_TIMEOUT)
+            await asyncio.to_thread(embedding_cache.put, question, EMBEDDING_MODEL_NAME, vector)
+    return vector
+
+
+async def load_corpus():
+    with stage_timer('corpus_load'):
+        return await asyncio.to_thread(get_data_from_bucket)
+
+
+async def prepare_prompt(question, session=None, filters=None):
+    """Async driver of pipeline.prompt_steps, like pipeline.prepare_prompt.
+
+    The corpus load and the query embedding are independent, so they run concurrently.
+    The neighbor lookup is awaited on the event loop; the steps in between (answer
+    cache, lexical search, MMR, context packing) are CPU bound and run on a thread.
+    """
+    # Read the generation before the corpus: a swap in between then invalidates it
+    generation = answer_cache.generation
+    corpus, qry_emb = await asyncio.gather(load_corpus(), embed_question(question), return_exceptions=True)
+    if isinstance(corpus, BaseException):
+        raise corpus
+    embed_error = None
+    if isinstance(qry_emb, BaseException):
+        qry_emb, embed_error = None, qry_emb
+
+    steps = prompt_steps(question, corpus, qry_emb, embed_error, session, filters, generation)
+    query, prepared = await asyncio.to_thread(advance, steps)
+    while query is not None:
+        try:
+            neighbors = await wait_async(neighbor_batcher.submit_future(query), 'find_neighbors',
+                                         FIND_NEIGHBORS_TIMEOUT)
+        except Exception as e:
+            query, prepared = await asyncio.to_thread(advance, steps, error=e)
+        else:
+            query, prepared = await asyncio.to_thread(advance, steps, neighbors)
+    return prepared
+
+
+@app.before_serving
+async def warm_up():
+    # Build the model handles, load the corpus and its indexes before the first request arrives
+    await asyncio.gather(
+        asyncio.to_thread(clients.embedding_model, EMBEDDING_MODEL_NAME),
+        asyncio.to_thread(clients.generative_model),
+        asyncio.to_thread(start)
+    )
+
+
+@app.route('/ask', methods=['POST'])
+@track_request('/ask')
+async def ask():
+    """Handle question asking and generate response."""
+    payload = await request.get_json()
+    question = payload.get('question', '')
+    if not question:
+        return jsonify({'error': 'No question provided'}), 400
+    try:
+        filters = get_filters(payload)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    session = get_session(payload)
+
+    try:
+        with deadline_scope(REQUEST_DEADLINE):
+            prepared = await prepare_prompt(question, session, filters)
+            if prepared.cached_answer is not None:
+                answer = prepared.cached_answer
+            else:
+                with stage_timer('generate'), generation_breaker.guard():
+                    chat = clients.generative_model().start_chat(history=[])
+                    answer = (await wait_async(chat.send_message_async(prepared.full_prompt), 'generate')).text
+    except DeadlineExceeded as e:
+        return jsonify(timeout_response(e)), 504
+    except CircuitOpenError as e:
+        return jsonify(unavailable_response(e)), 503
+    # History compaction may call the model synchronously
+    await asyncio.to_thread(complete_answer, question, answer, prepared, session)
+
+    if session:
+        return jsonify({'response': answer, 'session_id': session.session_id})
+    return jsonify({'response': answer})
+
+
+@app.route('/ask_stream', methods=['POST'])
+@track_request('/ask_stream')
+async def ask_stream():
+    """Handle question asking and stream the response as Server-Sent Events."""
+    payload = await request.get_json()
+    question = payload.get('question', '')
+    if not question:
+        return jsonify({'error': 'No question provided'}), 400
+    try:
+        filters = get_filters(payload)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    session = get_session(payload)
+
+    async def events():
+        try:
+            set_deadline(REQUEST_DEADLINE)
+            prepared = await prepare_prompt(question, session, filters)
+            if prepared.cached_answer is not None:
+                yield sse_event({'text': prepared.cached_answer})
+                await asyncio.to_thread(complete_answer, question, prepared.cached_answer, prepared, session)
+                yield sse_event({}, event='done')
+                return
+
+            parts = []
+            with stage_timer('generate'), generation_breaker.guard():
+                chat = clients.generative_model().start_chat(history=[])
+                async for chunk in await chat.send_message_async(prepared.full_prompt, stream=True):
+                    # Stop relaying once the budget is spent
+                    stage_timeout('generate')
+                    try:
+                        text = chunk.text
+                    except ValueError:  # chunk without text, e.g. only safety ratings
+                        continue
+                    parts.append(text)
+                    yield sse_event({'text': text})
+            await asyncio.to_thread(complete_answer, question, ''.join(parts), prepared, session)
+            yield sse_event({}, event='done')
+        except DeadlineExceeded as e:
+            yield sse_event(timeout_response(e), event='error')
+        except CircuitOpenError as e:
+            yield sse_event(unavailable_response(e), event='error')
+        except Exception as e:
+            app.logger.error(f"Error streaming answer: {str(e)}")
+            yield sse_event({'error': 'An error occurred.'}, event='error')
+
+    return Response(tracked_stream(events()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/ask_batch', methods=['POST'])
+@track_request('/ask_batch')
+async def ask_batch():
+    """Answer a list of questions and stream the results as JSON lines, in completion order."""
+    questions, concurrency, filters, error = parse_batch_request(await request.get_json())
+    if error:
+        return jsonify({'error': error}), 400
+
+    async def lines():
+        # The batch pipeline is thread based; pull its lines off the event loop
+        results = answer_batch(questions, concurrency, filters)
+        while (line := await asyncio.to_thread(next, results, None)) is not None:
+            yield line
+
+    return Response(tracked_stream(lines()), mimetype='application/x-ndjson')
+
+
+@app.route('/stats', methods=['GET'])
+async def stats():
+    """Report cache and corpus statistics."""
+    return jsonify(await asyncio.to_thread(stats_report))
+
+
+@app.route('/health', methods=['GET'])
+async def health():
+    """Report breaker states; degraded still answers with 200 since fallbacks keep serving."""
+    return jsonify(health_status())
+
+
+@app.route('/metrics', methods=['GET'])
+async def metrics():
+    """Expose Prometheus metrics."""
+    return Response(generate_latest(), mimetype=CONTENT_TYPE_LATEST)
+
+
+@app.route('/')
+async def index():
+    """Serve the main HTML page."""
+    return await render_template('index.html')
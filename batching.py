@@ -0,0 +1,96 @@
+# Copyright 2024 Google LLC
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#  https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import queue
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List
+
+logger = logging.getLogger(__name__)
+
+
+class MicroBatcher:
+    """Collect concurrent single-item calls into batches for one batched remote call.
+
+    Items submitted within max_wait seconds of the first item of a batch (up to
+    max_batch_size of them) are passed together to batch_fn, which must return one
+    result per item in the same order. Up to max_in_flight batches run at a time.
+    """
+
+    def __init__(self, batch_fn: Callable[[List[Any]], List[Any]], max_batch_size: int = 8,
+                 max_wait: float = 0.005, max_in_flight: int = 8, name: str = 'batcher'):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.name = name
+        self._queue: "queue.Queue" = queue.Queue()
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix=name)
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.items = 0
+        if max_batch_size > 1:
+            threading.Thread(target=self._collect, name=f"{name}-collector", daemon=True).start()
+
+    def submit_future(self, item: Any) -> Future:
+        """Queue an item and return a future for its result."""
+        future = Future()
+        if self.max_batch_size <= 1:
+            self._executor.submit(self._run, [(item, future)])
+        else:
+            self._queue.put((item, future))
+        return future
+
+    def submit(self, item: Any) -> Any:
+        """Queue an item and block until its batch has been processed."""
+        return self.submit_future(item).result()
+
+    def _collect(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._executor.submit(self._run, batch)
+
+    def _run(self, batch: List):
+        items = [item for item, _ in batch]
+        try:
+            results = self.batch_fn(items)
+            if len(results) != len(items):
+                raise RuntimeError(f"{self.name}: expected {len(items)} results, got {len(results)}")
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        with self._lock:
+            self.batches += 1
+            self.items += len(items)
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                'batches': self.batches,
+                'items': self.items,
+                'avg_batch_size': self.items / self.batches if self.batches else 0.0,
+                'max_batch_size': self.max_batch_size
+            }
@@ -0,0 +1,329 @@
+# Copyright 2024 Google LLC
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#  https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Offline micro-benchmarks for the serving and ingestion hot paths.
+
+Everything runs against synthetic data and deterministic stand-ins for the
+embedding model, the vector index and the LLM, so no GCP project or network
+access is needed. Results are written as JSON; pass --compare with an earlier
+results file to fail on regressions.
+
+    python benchmarks/run_benchmarks.py --records 100000 --output bench_results.json
+    python benchmarks/run_benchmarks.py --compare bench_results.json --threshold 0.2
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import platform
+import statistics
+import subprocess
+import tempfile
+from datetime import datetime
+from typing import Callable, Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(1, os.path.join(ROOT, 'data-ingestion'))
+
+from corpus import build_id_index, generate_context, load_blob_records  # noqa: E402
+from context_builder import ContextBuilder  # noqa: E402
+from createuploadembeddings import extract_sentences_from_pdf_bytes  # noqa: E402
+from process_municipal_docs import chunk_text, process_pdf  # noqa: E402
+
+WORDS = ("bigquery dataflow dataplex composer release feature preview general availability "
+         "region table query storage bylaw council minutes policy permit section amendment "
+         "schedule budget report municipality esquimalt support index vector").split()
+
+
+# Deterministic stand-ins for the remote services
+
+class FakeEmbedding:
+    def __init__(self, values):
+        self.values = values
+
+
+class FakeEmbeddingModel:
+    """Hash-seeded vectors, so the same text always gets the same embedding."""
+
+    def __init__(self, dimensions: int = 768):
+        self.dimensions = dimensions
+
+    def get_embeddings(self, texts: List[str]) -> List[FakeEmbedding]:
+        embeddings = []
+        for text in texts:
+            rng = random.Random(hashlib.sha256(text.encode('utf-8')).digest())
+            embeddings.append(FakeEmbedding([rng.uniform(-1, 1) for _ in range(self.dimensions)]))
+        return embeddings
+
+
+class FakeNeighbor:
+    def __init__(self, id, distance):
+        self.id = id
+        self.distance = distance
+
+
+class FakeIndex:
+    """Returns neighbors derived from the query vector, drawn from the corpus IDs."""
+
+    def __init__(self, ids: List[str]):
+        self.ids = ids
+
+    def find_neighbors(self, queries, num_neighbors=10):
+        results = []
+        for query in queries:
+            rng = random.Random(hash(tuple(round(value, 4) for value in query[:8])))
+            results.append([FakeNeighbor(rng.choice(self.ids), rng.random())
+                            for _ in range(num_neighbors)])
+        return results
+
+
+class FakeChatResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeChat:
+    def send_message(self, prompt: str) -> FakeChatResponse:
+        digest = hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+        return FakeChatResponse(f"* Answer {digest[:8]}\nBased on {len(prompt)} prompt characters.")
+
+
+class FakeGenerativeModel:
+    def start_chat(self, history=None) -> FakeChat:
+        return FakeChat()
+
+
+class FakeBlob:
+    """Minimal stand-in for a GCS blob holding JSONL text."""
+
+    def __init__(self, name: str, text: str):
+        self.name = name
+        self.text = text
+        self.size = len(text.encode('utf-8'))
+
+    def open(self, mode='rt', chunk_size=None):
+        return io.StringIO(self.text)
+
+    def download_as_text(self):
+        return self.text
+
+
+# Synthetic data
+
+def make_sentence(rng: random.Random, words: int = 18) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize()
+
+
+def make_records(count: int, dimensions: int, seed: int = 7) -> List[Dict]:
+    rng = random.Random(seed)
+    return [{
+        'id': f"{seed}-{i}",
+        'sentence': make_sentence(rng),
+        'embedding': [round(rng.uniform(-1, 1), 6) for _ in range(dimensions)]
+    } for i in range(count)]
+
+
+def make_pdf(pages: int, lines_per_page: int = 40, seed: int = 11) -> bytes:
+    """Build a small text-only PDF with the given number of pages."""
+    rng = random.Random(seed)
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None,
+               b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    page_ids = []
+    for _ in range(pages):
+        lines = [f"{make_sentence(rng, 6)}. {make_sentence(rng, 6)}. " for _ in range(lines_per_page)]
+        stream = "BT /F1 9 Tf 40 800 Td 11 TL\n" + "".join(f"({line}) Tj T*\n" for line in lines) + "ET"
+        stream = stream.encode('latin-1')
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+        content_id = len(objects)
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 842] "
+                       b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % content_id)
+        page_ids.append(len(objects))
+    kids = b" ".join(b"%d 0 R" % page_id for page_id in page_ids)
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, len(page_ids))
+
+    output = io.BytesIO()
+    output.write(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(output.tell())
+        output.write(b"%d 0 obj\n%s\nendobj\n" % (number, body))
+    xref_offset = output.tell()
+    output.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+    for offset in offsets:
+        output.write(b"%010d 00000 n \n" % offset)
+    output.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n"
+                 % (len(objects) + 1, xref_offset))
+    return output.getvalue()
+
+
+# Timing
+
+def measure(fn: Callable[[], object], repeat: int, items: int = 0) -> Dict:
+    """Run fn once to warm up, then repeat times, and summarize the wall-clock timings."""
+    fn()
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+    result = {
+        'runs': repeat,
+        'min_s': timings[0],
+        'median_s': statistics.median(timings),
+        'mean_s': statistics.fmean(timings),
+        'p95_s': timings[min(len(timings) - 1, int(round(0.95 * (len(timings) - 1))))]
+    }
+    if items:
+        result['items'] = items
+        result['items_per_s'] = items / result['median_s'] if result['median_s'] else None
+    return result
+
+
+def run_benchmarks(args) -> Dict[str, Dict]:
+    records = make_records(args.records, args.dimensions)
+    ids = [record['id'] for record in records]
+    results = {}
+
+    # Serving: context assembly for one /ask
+    id_index = build_id_index(records)
+    rng = random.Random(3)
+    queries = [[rng.choice(ids) for _ in range(args.neighbors)] for _ in range(1000)]
+    results['build_id_index'] = measure(lambda: build_id_index(records), args.repeat, len(records))
+    results['generate_context'] = measure(
+        lambda: [generate_context(query, records, id_index) for query in queries],
+        args.repeat, len(queries))
+
+    # Serving: corpus loading, JSONL parsing of the embedding files
+    lines = [json.dumps(record) for record in records]
+    per_blob = max(1, len(lines) // args.blobs)
+    blobs = [FakeBlob(f"part-{i}.json", "\n".join(lines[start:start + per_blob]))
+             for i, start in enumerate(range(0, len(lines), per_blob))]
+    results['load_blob_records'] = measure(
+        lambda: [load_blob_records(blob, ('id', 'sentence', 'embedding')) for blob in blobs],
+        args.repeat, len(records))
+
+    # Serving: end-to-end /ask path with the fake remote services
+    embedding_model = FakeEmbeddingModel(args.dimensions)
+    index = FakeIndex(ids)
+    llm = FakeGenerativeModel()
+    context_builder = ContextBuilder(token_budget=args.token_budget)
+    questions = [make_sentence(rng, 8) + "?" for _ in range(200)]
+
+    def ask_pipeline():
+        for question in questions:
+            query = embedding_model.get_embeddings([question])[0].values
+            neighbors = index.find_neighbors([query], args.neighbors)[0]
+            sentences = generate_context([n.id for n in neighbors], records, id_index).split("\n")
+            context, _ = context_builder.build(sentences)
+            llm.start_chat(history=[]).send_message(f"```{context}``` {question}")
+
+    results['ask_pipeline_fake_services'] = measure(ask_pipeline, args.repeat, len(questions))
+
+    # Ingestion: text chunking, PDF extraction and JSON serialization
+    text = "\n".join(make_sentence(rng) + "." for _ in range(args.text_sentences))
+    results['chunk_text'] = measure(lambda: chunk_text(text), args.repeat, len(text))
+
+    pdf_bytes = make_pdf(args.pdf_pages)
+    results['extract_sentences_from_pdf'] = measure(
+        lambda: extract_sentences_from_pdf_bytes(io.BytesIO(pdf_bytes)), args.repeat, args.pdf_pages)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        pdf_path = os.path.join(tmp_dir, 'council_minutes_2023.pdf')
+        with open(pdf_path, 'wb') as pdf_file:
+            pdf_file.write(pdf_bytes)
+        results['process_pdf_chunks'] = measure(lambda: process_pdf(pdf_path), args.repeat, args.pdf_pages)
+
+    results['json_dumps_embedding_lines'] = measure(
+        lambda: [json.dumps(record) for record in records], args.repeat, len(records))
+    chunks = [{'text': text[i:i + 1000], 'metadata': {'chunk_index': i}}
+              for i in range(0, len(text), 1000)]
+    results['json_dumps_chunks'] = measure(lambda: json.dumps(chunks, indent=2), args.repeat, len(chunks))
+    return results
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, check=True,
+                              capture_output=True, text=True).stdout.strip()
+    except Exception:
+        return 'unknown'
+
+
+def compare(results: Dict[str, Dict], baseline: Dict[str, Dict], threshold: float) -> List[str]:
+    """Return the benchmarks whose median got slower than baseline by more than threshold."""
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before, after = baseline[name]['median_s'], result['median_s']
+        change = (after - before) / before if before else 0.0
+        print(f"{name:32s} {before * 1000:10.2f} ms -> {after * 1000:10.2f} ms  {change:+.1%}")
+        if change > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, default=20000, help='synthetic corpus size')
+    parser.add_argument('--dimensions', type=int, default=768, help='embedding dimensions')
+    parser.add_argument('--blobs', type=int, default=8, help='number of embedding files')
+    parser.add_argument('--neighbors', type=int, default=10, help='neighbors per query')
+    parser.add_argument('--token-budget', type=int, default=2000, help='context token budget')
+    parser.add_argument('--text-sentences', type=int, default=20000, help='sentences for chunk_text')
+    parser.add_argument('--pdf-pages', type=int, default=50, help='pages in the synthetic PDF')
+    parser.add_argument('--repeat', type=int, default=5, help='timed runs per benchmark')
+    parser.add_argument('--output', default='bench_results.json', help='where to write the results')
+    parser.add_argument('--compare', help='earlier results file to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='allowed median slowdown before --compare fails (0.2 = 20%%)')
+    args = parser.parse_args()
+
+    # Read the baseline first, it may be the file this run overwrites
+    baseline = None
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)['results']
+
+    results = run_benchmarks(args)
+    report = {
+        'revision': git_revision(),
+        'timestamp': datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'params': vars(args),
+        'results': results
+    }
+    with open(args.output, 'w') as output_file:
+        json.dump(report, output_file, indent=2)
+
+    for name, result in results.items():
+        rate = f"{result['items_per_s']:.0f} items/s" if result.get('items_per_s') else ''
+        print(f"{name:32s} median {result['median_s'] * 1000:10.2f} ms  {rate}")
+    print(f"Results written to {args.output}")
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"Regressions over {args.threshold:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+# Copyright 2024 Google LLC
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#  https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Callable, Dict
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+# Numeric state for metrics
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a dependency whose circuit is open."""
+
+    def __init__(self, name: str):
+        super().__init__(f"Circuit {name} is open")
+        self.name = name
+
+
+class CircuitBreaker:
+    """Stop calling a failing remote dependency and probe it until it recovers.
+
+    Over the last window calls, errors and calls slower than slow_call_seconds count
+    as failures. Once at least min_calls were seen and the failure rate reaches
+    failure_rate, the circuit opens and calls fail fast with CircuitOpenError. After
+    open_seconds it turns half-open and lets up to half_open_probes calls through:
+    if they all succeed the circuit closes, any failure opens it again.
+    """
+
+    def __init__(self, name: str, failure_rate: float = 0.5, min_calls: int = 10, window: int = 50,
+                 slow_call_seconds: float = 0, open_seconds: float = 30, half_open_probes: int = 3):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.slow_call_seconds = slow_call_seconds
+        self.open_seconds = open_seconds
+        self.half_open_probes = half_open_probes
+        self.state = CLOSED
+        self._outcomes: "deque[bool]" = deque(maxlen=window)
+        self._opened_at = 0.0
+        self._probes_started = 0
+        self._probes_passed = 0
+        self._lock = threading.Lock()
+        self.opened = 0
+        self.rejected = 0
+        self.failures = 0
+
+    def allow(self):
+        """Reserve a call; raises CircuitOpenError if the dependency must not be called."""
+        with self._lock:
+            if self.state == OPEN:
+                if time.monotonic() - self._opened_at < self.open_seconds:
+                    self.rejected += 1
+                    raise CircuitOpenError(self.name)
+                self.state = HALF_OPEN
+                self._probes_started = 0
+                self._probes_passed = 0
+                logger.info(f"Circuit {self.name} half-open, probing")
+            if self.state == HALF_OPEN:
+                if self._probes_started >= self.half_open_probes:
+                    self.rejected += 1
+                    raise CircuitOpenError(self.name)
+                self._probes_started += 1
+
+    def record(self, success: bool, elapsed: float = 0.0):
+        """Record the outcome of a call reserved with allow()."""
+        if self.slow_call_seconds > 0 and elapsed > self.slow_call_seconds:
+            success = False
+        with self._lock:
+            if not success:
+                self.failures += 1
+            if self.state == HALF_OPEN:
+                if not success:
+                    self._open()
+                else:
+                    self._probes_passed += 1
+                    if self._probes_passed >= self.half_open_probes:
+                        self.state = CLOSED
+                        self._outcomes.clear()
+                        logger.info(f"Circuit {self.name} closed")
+                return
+            self._outcomes.append(success)
+            failed = self._outcomes.count(False)
+            if (self.state == CLOSED and len(self._outcomes) >= self.min_calls
+                    and failed / len(self._outcomes) >= self.failure_rate):
+                self._open()
+
+    def _open(self):
+        self.state = OPEN
+        self._opened_at = time.monotonic()
+        self._outcomes.clear()
+        self.opened += 1
+        logger.warning(f"Circuit {self.name} opened")
+
+    def call(self, fn: Callable, *args) -> Any:
+        """Call fn through the breaker."""
+        self.allow()
+        started = time.monotonic()
+        try:
+            result = fn(*args)
+        except Exception:
+            self.record(False, time.monotonic() - started)
+            raise
+        self.record(True, time.monotonic() - started)
+        return result
+
+    @contextmanager
+    def guard(self):
+        """Reserve a call for the block, e.g. while a streamed response is consumed;
+        exceptions raised in the block count as failures."""
+        self.allow()
+        started = time.monotonic()
+        failed = False
+        try:
+            yield
+        except Exception:
+            failed = True
+            raise
+        finally:
+            self.record(not failed, time.monotonic() - started)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            # An expired open period only turns half-open on the next call
+            return {
+                'state': self.state,
+                'state_value': STATE_VALUES[self.state],
+                'failure_rate': self._outcomes.count(False) / len(self._outcomes) if self._outcomes else 0.0,
+                'opened': self.opened,
+                'rejected': self.rejected,
+                'failures': self.failures
+            }
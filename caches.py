@@ -0,0 +1,274 @@
+# Copyright 2024 Google LLC
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#  https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import re
+import json
+import time
+import sqlite3
+import logging
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_question(text: str) -> str:
+    """Normalize question text so trivially different phrasings share a cache key."""
+    text = unicodedata.normalize('NFKC', text).casefold()
+    return re.sub(r'\s+', ' ', text).strip()
+
+
+class EmbeddingCache:
+    """Bounded LRU cache of query embeddings with TTL and an optional on-disk tier."""
+
+    def __init__(self, max_size: int = 1024, ttl: float = 3600, path: Optional[str] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: "OrderedDict[Tuple[str, str], Tuple[float, List[float]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings "
+                "(model TEXT, question TEXT, stored_at REAL, vector TEXT, "
+                "PRIMARY KEY (model, question))"
+            )
+            if ttl > 0:
+                # Drop entries that expired while the process was down
+                self._db.execute("DELETE FROM embeddings WHERE stored_at < ?", (time.time() - ttl,))
+            self._db.commit()
+
+    def _expired(self, stored_at: float, now: float) -> bool:
+        return self.ttl > 0 and now - stored_at > self.ttl
+
+    def _read_disk(self, key: Tuple[str, str], now: float) -> Optional[List[float]]:
+        row = self._db.execute(
+            "SELECT stored_at, vector FROM embeddings WHERE model = ? AND question = ?", key
+        ).fetchone()
+        if row is None:
+            return None
+        if self._expired(row[0], now):
+            self._db.execute("DELETE FROM embeddings WHERE model = ? AND question = ?", key)
+            self._db.commit()
+            return None
+        vector = json.loads(row[1])
+        self._store(key, row[0], vector)
+        return vector
+
+    def _store(self, key: Tuple[str, str], stored_at: float, vector: List[float]):
+        self._entries[key] = (stored_at, vector)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, text: str, model_name: str) -> Optional[List[float]]:
+        """Return the cached vector for text, or None on a miss."""
+        key = (model_name, normalize_question(text))
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if not self._expired(entry[0], now):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self._entries[key]
+            if self._db is not None:
+                vector = self._read_disk(key, now)
+                if vector is not None:
+                    self.disk_hits += 1
+                    return vector
+            self.misses += 1
+            return None
+
+    def put(self, text: str, model_name: str, vector: List[float]):
+        """Store the vector for text in memory and, if configured, on disk."""
+        key = (model_name, normalize_question(text))
+        now = time.time()
+        with self._lock:
+            self._store(key, now, vector)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)",
+                    (*key, now, json.dumps(vector))
+                )
+                self._db.commit()
+
+    def get_or_compute(self, text: str, model_name: str,
+                       compute: Callable[[str], List[float]]) -> List[float]:
+        """Return the cached vector for text, computing and caching it on a miss."""
+        vector = self.get(text, model_name)
+        if vector is None:
+            vector = compute(text)
+            self.put(text, model_name, vector)
+        return vector
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': (self.hits + self.disk_hits) / lookups if lookups else 0.0
+            }
+
+
+class AnswerCache:
+    """Bounded cache of generated answers, matched by cosine distance between query vectors.
+
+    Entries are tagged with the corpus generation they were answered from; bumping
+    the generation with invalidate() drops every entry. An entry only matches lookups
+    with the same scope (e.g. the retrieval filters the answer was generated under).
+    """
+
+    def __init__(self, max_size: int = 512, max_distance: float = 0.05, ttl: float = 3600):
+        self.max_size = max_size
+        self.max_distance = max_distance
+        self.ttl = ttl
+        self.generation = 0
+        self._lock = threading.Lock()
+        # Unit query vectors live in one preallocated matrix so a lookup is a single
+        # matrix-vector product; per-row arrays hold each entry's store time and scope
+        # ID, so a lookup masks by scope and age without a Python loop. _slots maps
+        # matrix rows to (answer, scope) in LRU order
+        self._vectors = None
+        self._valid = None
+        self._stored_at = None
+        self._scopes = None
+        self._slots: "OrderedDict[int, Tuple[str, str]]" = OrderedDict()
+        self._free: List[int] = list(range(max_size))
+        # scope -> small integer ID, and how many entries use it
+        self._scope_ids: Dict[str, int] = {}
+        self._scope_sizes: Dict[str, int] = {}
+        self._next_scope_id = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def _unit(vector: List[float]) -> np.ndarray:
+        vector = np.asarray(vector, dtype='float32')
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _scope_id(self, scope: str) -> int:
+        scope_id = self._scope_ids.get(scope)
+        if scope_id is None:
+            scope_id = self._scope_ids[scope] = self._next_scope_id
+            self._scope_sizes[scope] = 0
+            self._next_scope_id += 1
+        self._scope_sizes[scope] += 1
+        return scope_id
+
+    def _release(self, slot: int):
+        _, scope = self._slots.pop(slot)
+        self._valid[slot] = False
+        self._scopes[slot] = -1
+        self._free.append(slot)
+        self._scope_sizes[scope] -= 1
+        if not self._scope_sizes[scope]:
+            del self._scope_sizes[scope], self._scope_ids[scope]
+
+    def lookup(self, vector: List[float], generation: int, scope: str = '') -> Optional[str]:
+        """Return the answer of the closest cached question within max_distance, if any.
+
+        Expired entries of the scope are dropped first, so an expired closest match
+        does not hide a valid one behind it.
+        """
+        if self.max_size <= 0:
+            return None
+        query = self._unit(vector)
+        now = time.time()
+        with self._lock:
+            scope_id = self._scope_ids.get(scope)
+            if scope_id is None or generation != self.generation:
+                self.misses += 1
+                return None
+            candidates = self._valid & (self._scopes == scope_id)
+            if self.ttl > 0:
+                expired = candidates & (self._stored_at < now - self.ttl)
+                if expired.any():
+                    for slot in np.flatnonzero(expired):
+                        self._release(int(slot))
+                    candidates &= ~expired
+            similarities = self._vectors @ query
+            similarities[~candidates] = -np.inf
+            slot = int(np.argmax(similarities))
+            if similarities[slot] == -np.inf or 1.0 - float(similarities[slot]) > self.max_distance:
+                self.misses += 1
+                return None
+            answer, _ = self._slots[slot]
+            self._slots.move_to_end(slot)
+            self.hits += 1
+            return answer
+
+    def put(self, vector: List[float], answer: str, generation: int, scope: str = ''):
+        """Cache an answer unless the corpus was reloaded while it was being generated."""
+        if self.max_size <= 0:
+            return
+        query = self._unit(vector)
+        with self._lock:
+            if generation != self.generation:
+                return
+            if self._vectors is None:
+                self._vectors = np.zeros((self.max_size, len(query)), dtype='float32')
+                self._valid = np.zeros(self.max_size, dtype=bool)
+                self._stored_at = np.zeros(self.max_size, dtype='float64')
+                self._scopes = np.full(self.max_size, -1, dtype='int64')
+            if not self._free:
+                self._release(next(iter(self._slots)))
+                self.evictions += 1
+            slot = self._free.pop()
+            self._vectors[slot] = query
+            self._valid[slot] = True
+            self._stored_at[slot] = time.time()
+            self._scopes[slot] = self._scope_id(scope)
+            self._slots[slot] = (answer, scope)
+
+    def invalidate(self) -> int:
+        """Drop every entry and start a new corpus generation."""
+        with self._lock:
+            self.generation += 1
+            for slot in list(self._slots):
+                self._release(slot)
+            self.invalidations += 1
+            return self.generation
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._slots),
+                'max_size': self.max_size,
+                'generation': self.generation,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'hit_rate': self.hits / lookups if lookups else 0.0
+            }
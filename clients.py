@@ -0,0 +1,134 @@
+# Copyright 2024 Google LLC
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#  https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This module is mirrored in data-ingestion/clients.py because the serving app
+# and the ingestion service are built as separate container images.
+
+import os
+import time
+import logging
+import threading
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import google.auth
+from google.cloud import aiplatform
+from vertexai.language_models import TextEmbeddingModel
+from vertexai.preview.generative_models import GenerativeModel
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_MODEL_NAME = "textembedding-gecko@001"
+GENERATIVE_MODEL_NAME = "gemini-pro"
+
+# How often (seconds) to check whether the credentials file has been rotated
+CREDENTIALS_CHECK_INTERVAL = float(os.getenv('CLIENT_CREDENTIALS_CHECK_INTERVAL', '30'))
+
+
+def _credentials_fingerprint() -> Tuple[Optional[str], Optional[float]]:
+    """Identify the active credentials file so a rotation can be detected."""
+    path = os.getenv('GOOGLE_APPLICATION_CREDENTIALS')
+    if not path:
+        return None, None
+    try:
+        return path, os.stat(path).st_mtime
+    except OSError:
+        return path, None
+
+
+class ClientRegistry:
+    """Build Vertex AI handles once per process and share them across threads."""
+
+    def __init__(self, project_id: str, location: str):
+        self.project_id = project_id
+        self.location = location
+        self._lock = threading.Lock()
+        self._handles: Dict[Tuple, Any] = {}
+        self._initialized = False
+        self._fingerprint = _credentials_fingerprint()
+        self._last_check = time.monotonic()
+
+    def _init_platform(self, credentials=None):
+        aiplatform.init(project=self.project_id, location=self.location, credentials=credentials)
+        self._initialized = True
+
+    def _check_credentials(self):
+        """Drop cached handles if the credentials file changed since the last check."""
+        now = time.monotonic()
+        if now - self._last_check < CREDENTIALS_CHECK_INTERVAL:
+            return
+        self._last_check = now
+        fingerprint = _credentials_fingerprint()
+        if fingerprint != self._fingerprint:
+            logger.info("Credentials changed, rebuilding Vertex AI clients")
+            self.invalidate()
+
+    def ensure_initialized(self):
+        """Run aiplatform.init for this project and location once."""
+        self._check_credentials()
+        if self._initialized:
+            return
+        with self._lock:
+            if not self._initialized:
+                self._init_platform()
+
+    def get(self, key: Tuple, factory: Callable[[], Any]) -> Any:
+        """Return the handle stored under key, building it with factory on first use."""
+        self.ensure_initialized()
+        handle = self._handles.get(key)
+        if handle is not None:
+            return handle
+        with self._lock:
+            handle = self._handles.get(key)
+            if handle is None:
+                handle = factory()
+                self._handles[key] = handle
+            return handle
+
+    def invalidate(self):
+        """Forget every handle and re-initialize with freshly loaded credentials."""
+        with self._lock:
+            self._handles.clear()
+            self._fingerprint = _credentials_fingerprint()
+            if self._initialized:
+                credentials, _ = google.auth.default()
+                self._init_platform(credentials)
+
+    def embedding_model(self, model_name: str = EMBEDDING_MODEL_NAME) -> TextEmbeddingModel:
+        return self.get(('embedding', model_name),
+                        lambda: TextEmbeddingModel.from_pretrained(model_name))
+
+    def generative_model(self, model_name: str = GENERATIVE_MODEL_NAME) -> GenerativeModel:
+        return self.get(('generative', model_name), lambda: GenerativeModel(model_name))
+
+    def index_endpoint(self, index_endpoint_name: str) -> aiplatform.MatchingEngineIndexEndpoint:
+        return self.get(('index_endpoint', index_endpoint_name),
+                        lambda: aiplatform.MatchingEngineIndexEndpoint(
+                            index_endpoint_name=index_endpoint_name))
+
+    def index(self, index_id: str) -> aiplatform.MatchingEngineIndex:
+        return self.get(('index', index_id),
+                        lambda: aiplatform.MatchingEngineIndex(index_name=index_id))
+
+
+_registries: Dict[Tuple[str, str], ClientRegistry] = {}
+_registries_lock = threading.Lock()
+
+
+def get_registry(project_id: str, location: str) -> ClientRegistry:
+    """Return the process-wide registry for a project and location."""
+    key = (project_id, location)
+    registry = _registries.get(key)
+    if registry is None:
+        with _registries_lock:
+            registry = _registries.setdefault(key, ClientRegistry(project_id, location))
+    return registry
@@ -0,0 +1,117 @@
+# Copyright 2024 Google LLC
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#  https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import re
+import logging
+import threading
+from typing import Dict, List, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def _word_set(text: str) -> Set[str]:
+    return set(re.findall(r'\w+', text.lower()))
+
+
+class ContextBuilder:
+    """Pack retrieved sentences into the prompt context within a token budget.
+
+    Sentences are taken in neighbor rank order. Exact and near duplicates (word-set
+    Jaccard similarity at or above dedup_threshold) of an already selected sentence
+    are dropped, and sentences that no longer fit the budget are skipped. Token counts
+    come from tiktoken, which approximates Gemini's tokenizer closely enough for
+    budgeting.
+    """
+
+    def __init__(self, token_budget: int = 2000, dedup_threshold: float = 0.9,
+                 encoding_name: str = 'cl100k_base'):
+        self.token_budget = token_budget
+        self.dedup_threshold = dedup_threshold
+        self.encoding_name = encoding_name
+        self._encoding = None
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.tokens_used = 0
+        self.duplicates_dropped = 0
+        self.over_budget_dropped = 0
+
+    def count_tokens(self, text: str) -> int:
+        if self._encoding is None:
+            try:
+                import tiktoken
+                self._encoding = tiktoken.get_encoding(self.encoding_name)
+            except Exception as e:
+                # Fall back to the usual ~4 characters per token estimate
+                logger.warning(f"tiktoken unavailable, estimating token counts: {str(e)}")
+                self._encoding = False
+        if self._encoding is False:
+            return max(1, len(text) // 4)
+        return len(self._encoding.encode(text, disallowed_special=()))
+
+    def _is_duplicate(self, words: Set[str], selected: List[Set[str]]) -> bool:
+        for other in selected:
+            union = len(words | other)
+            if union and len(words & other) / union >= self.dedup_threshold:
+                return True
+        return False
+
+    def build(self, sentences: List[str]) -> Tuple[str, Dict]:
+        """Return the packed context and the token usage for this request."""
+        selected = []
+        selected_words: List[Set[str]] = []
+        tokens = 0
+        duplicates = 0
+        over_budget = 0
+        # Each selected sentence is followed by a newline separator
+        separator_tokens = 1
+
+        for sentence in sentences:
+            sentence = sentence.strip()
+            if not sentence:
+                continue
+            words = _word_set(sentence)
+            if self._is_duplicate(words, selected_words):
+                duplicates += 1
+                continue
+            cost = self.count_tokens(sentence) + separator_tokens
+            if self.token_budget > 0 and tokens + cost > self.token_budget:
+                over_budget += 1
+                continue
+            selected.append(sentence)
+            selected_words.append(words)
+            tokens += cost
+
+        usage = {
+            'context_tokens': tokens,
+            'token_budget': self.token_budget,
+            'items_used': len(selected),
+            'duplicates_dropped': duplicates,
+            'over_budget_dropped': over_budget
+        }
+        with self._lock:
+            self.requests += 1
+            self.tokens_used += tokens
+            self.duplicates_dropped += duplicates
+            self.over_budget_dropped += over_budget
+        logger.debug(f"Context packed: {usage}")
+        return "\n".join(selected), usage
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'token_budget': self.token_budget,
+                'avg_context_tokens': self.tokens_used / self.requests if self.requests else 0.0,
+                'duplicates_dropped': self.duplicates_dropped,
+                'over_budget_dropped': self.over_budget_dropped
+            }
@@ -0,0 +1,305 @@
+# Copyright 2024 Google LLC
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#  https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from google.cloud import storage
+from prometheus_client import Counter, Histogram
+
+from metrics import LATENCY_BUCKETS
+from shared_corpus import SharedCorpusDirectory
+
+logger = logging.getLogger(__name__)
+
+# Record fields /ask needs; anything else in the embedding files is dropped at load time.
+# Release-note embeddings carry `sentence`, municipal document chunks carry `text`.
+SERVING_FIELDS = ('id', 'sentence', 'text')
+TEXT_FIELDS = ('sentence', 'text')
+# Size of each ranged read when streaming a blob
+STREAM_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Load throughput is rate(corpus_download_bytes_total) / rate(corpus_download_seconds_sum)
+CORPUS_DOWNLOAD_SECONDS = Histogram('corpus_download_seconds', 'Time to download and parse changed blobs',
+                                    buckets=LATENCY_BUCKETS)
+CORPUS_DOWNLOAD_BYTES = Counter('corpus_download_bytes_total', 'Bytes of embedding files downloaded')
+CORPUS_DOWNLOAD_RECORDS = Counter('corpus_download_records_total', 'Records parsed from downloaded files')
+CORPUS_LOAD_SECONDS = Histogram('corpus_load_seconds', 'Time to build each corpus generation',
+                                buckets=LATENCY_BUCKETS)
+
+
+def load_blob_records(blob, fields: Iterable[str] = SERVING_FIELDS) -> Tuple[List[Dict], Optional[np.ndarray]]:
+    """Stream the JSONL records of one embeddings blob, keeping only the given fields.
+
+    The blob is read in chunks and parsed line by line, so the full file text is
+    never held in memory next to the parsed records. With `embedding` among the
+    fields, the vectors come back as a float32 matrix aligned with the records
+    (zero rows where a record has none) rather than as a list in each record;
+    otherwise the matrix is None.
+    """
+    fields = tuple(fields)
+    keep_embeddings = 'embedding' in fields
+    fields = tuple(field for field in fields if field != 'embedding')
+    records, vectors = [], []
+    with blob.open('rt', chunk_size=STREAM_CHUNK_SIZE) as blob_file:
+        for line in blob_file:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            records.append({field: entry[field] for field in fields if field in entry})
+            if keep_embeddings:
+                embedding = entry.get('embedding')
+                vectors.append(np.asarray(embedding, dtype='float32') if embedding else None)
+    return records, embedding_matrix(vectors) if keep_embeddings else None
+
+
+def embedding_matrix(vectors: List[Optional[np.ndarray]]) -> np.ndarray:
+    """Stack vectors into a float32 matrix, with a zero row for each missing one."""
+    dim = next((len(vector) for vector in vectors if vector is not None), 0)
+    matrix = np.zeros((len(vectors), dim), dtype='float32')
+    for offset, vector in enumerate(vectors):
+        if vector is not None:
+            matrix[offset] = vector
+    return matrix
+
+
+def record_text(entry: Dict) -> str:
+    """Return the text of a record, whichever of the serving text fields it carries."""
+    return entry.get('sentence') or entry.get('text') or ''
+
+
+def build_id_index(data: List[Dict]) -> Dict[str, int]:
+    """Map each record ID to its offset in the loaded corpus."""
+    id_index = {}
+    for offset, entry in enumerate(data):
+        # Keep the first occurrence so lookups match the old linear scan order
+        id_index.setdefault(entry['id'], offset)
+    return id_index
+
+
+def lookup_sentences(ids: List[str], data: List[Dict], id_index: Dict[str, int]) -> List[str]:
+    """Return the sentences for the given IDs, keeping neighbor rank order."""
+    seen = set()
+    sentences = []
+    for id in ids:
+        if id in seen:
+            continue
+        seen.add(id)
+        offset = id_index.get(id)
+        if offset is not None:
+            sentences.append(record_text(data[offset]))
+    return sentences
+
+
+def generate_context(ids: List[str], data: List[Dict], id_index: Dict[str, int]) -> str:
+    """Generate context based on IDs, keeping neighbor rank order."""
+    return "\n".join(lookup_sentences(ids, data, id_index)).strip()
+
+
+class Corpus:
+    """Immutable snapshot of the embedding records loaded from the bucket.
+
+    Embeddings, when loaded, live in one float32 matrix whose rows line up with
+    records; embedded marks the rows that have one.
+    """
+
+    def __init__(self, blobs: Dict[str, Tuple[int, List[Dict], Optional[np.ndarray]]], generation: int):
+        # blob name -> (GCS blob generation, records parsed from that blob, their embeddings)
+        self.generation = generation
+        names = sorted(blobs)
+        self.records = [entry for name in names for entry in blobs[name][1]]
+        self.id_index = build_id_index(self.records)
+        self.blobs = dict(blobs)
+        self.embeddings, self.embedded = None, None
+        matrices = [blobs[name][2] for name in names if blobs[name][2] is not None]
+        if matrices:
+            dim = max(matrix.shape[1] for matrix in matrices)
+            self.embeddings = np.zeros((len(self.records), dim), dtype='float32')
+            self.embedded = np.zeros(len(self.records), dtype=bool)
+            start = 0
+            for name in names:
+                generation, records, matrix = blobs[name]
+                end = start + len(records)
+                if matrix is not None and matrix.shape[1] == dim:
+                    self.embeddings[start:end] = matrix
+                    self.embedded[start:end] = matrix.any(axis=1)
+                elif matrix is not None and len(matrix) and matrix.shape[1]:
+                    logger.warning(f"Ignoring embeddings of {name}: dimension {matrix.shape[1]}, expected {dim}")
+                # Blobs keep views into the corpus matrix, so the per-blob copies can be freed
+                self.blobs[name] = (generation, records, self.embeddings[start:end])
+                start = end
+        self.loaded_at = datetime.utcnow()
+
+    def column(self, field: str) -> List[Optional[str]]:
+        """The values of one field by record offset (None where a record has none)."""
+        return [entry.get(field) for entry in self.records]
+
+    def select(self, fields: Iterable[str]) -> Iterable[Dict]:
+        """Records with at least the given fields, for index builds (see SharedCorpus.select)."""
+        return self.records
+
+
+class CorpusStore:
+    """Hold the current corpus and refresh it incrementally from the bucket.
+
+    A refresh lists the bucket, downloads only blobs whose GCS generation changed,
+    builds the new snapshot next to the old one and swaps it in with a single
+    assignment, so in-flight requests keep reading the snapshot they started with.
+
+    With shared_dir set, snapshots are published to that directory (see
+    shared_corpus) and memory-mapped, so worker processes share one copy.
+    """
+
+    def __init__(self, bucket_name: str, suffix: str = '.json',
+                 fields: Iterable[str] = SERVING_FIELDS, max_workers: int = 8,
+                 shared_dir: Optional[str] = None):
+        self.bucket_name = bucket_name
+        self.suffix = suffix
+        self.fields = tuple(fields)
+        self.max_workers = max_workers
+        self.shared = SharedCorpusDirectory(shared_dir) if shared_dir else None
+        self._corpus: Optional[Corpus] = None
+        self._load_lock = threading.Lock()
+        self._listeners: List[Callable[[Corpus], None]] = []
+        self._thread = None
+        self.last_refresh: Optional[datetime] = None
+        self.last_error: Optional[str] = None
+
+    def on_swap(self, listener: Callable[[Corpus], None]):
+        """Call listener with the new corpus after every refresh that changed it."""
+        self._listeners.append(listener)
+
+    def get(self) -> Corpus:
+        """Return the current corpus, loading it on first use."""
+        corpus = self._corpus
+        if corpus is None:
+            with self._load_lock:
+                if self._corpus is None:
+                    self._refresh_locked(notify=False)
+                corpus = self._corpus
+        return corpus
+
+    def refresh(self) -> bool:
+        """Pick up new, changed and deleted blobs. Returns True if the corpus changed."""
+        with self._load_lock:
+            return self._refresh_locked(notify=True)
+
+    def _refresh_locked(self, notify: bool) -> bool:
+        old = self._corpus
+        if self.shared is None:
+            corpus = self._load_changes(old)
+        else:
+            # Another worker process may already have published a newer snapshot; only
+            # one process at a time downloads and publishes
+            with self.shared.lock():
+                attached = self.shared.attach_newer(old.generation if old else 0)
+                # Packed straight from the downloaded and the attached blobs, without
+                # decoding the attached snapshot into an in-memory Corpus first
+                corpus = self._load_changes(
+                    attached or old,
+                    lambda blobs, generation: self.shared.publish(blobs, generation, self.fields))
+                corpus = corpus or attached
+        if corpus is None:
+            return False
+        self._corpus = corpus
+
+        if notify:
+            for listener in self._listeners:
+                try:
+                    listener(corpus)
+                except Exception as e:
+                    logger.error(f"Corpus swap listener failed: {str(e)}")
+        return True
+
+    def _load_changes(self, old: Optional[Corpus], build: Callable = Corpus) -> Optional[Corpus]:
+        """Build the next corpus from old and the blobs that changed since, or None if nothing did.
+
+        build(blobs, generation) creates the corpus from the blobs of the new snapshot.
+        """
+        old_blobs = old.blobs if old else {}
+        storage_client = storage.Client()
+
+        listed = {blob.name: blob for blob in storage_client.list_blobs(self.bucket_name)
+                  if blob.name.endswith(self.suffix)}
+        changed = [blob for name, blob in listed.items()
+                   if name not in old_blobs or old_blobs[name][0] != blob.generation]
+        removed = set(old_blobs) - set(listed)
+        self.last_refresh = datetime.utcnow()
+        if old is not None and not changed and not removed:
+            return None
+
+        started = time.monotonic()
+        blobs = {name: old_blobs[name] for name in listed if name in old_blobs}
+        blobs.update(self._download(changed))
+        corpus = build(blobs, old.generation + 1 if old else 1)
+        CORPUS_LOAD_SECONDS.observe(time.monotonic() - started)
+        logger.info(f"Loaded corpus generation {corpus.generation}: {len(blobs)} blobs, "
+                    f"{len(corpus.records)} records ({len(changed)} changed, {len(removed)} removed) "
+                    f"in {time.monotonic() - started:.1f}s")
+        return corpus
+
+    def _download(self, blobs: List) -> Dict[str, Tuple[int, List[Dict], Optional[np.ndarray]]]:
+        """Download and parse blobs concurrently on a bounded thread pool."""
+        if not blobs:
+            return {}
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            parsed = list(executor.map(lambda blob: load_blob_records(blob, self.fields), blobs))
+        elapsed = max(time.monotonic() - started, 1e-6)
+
+        total_bytes = sum(blob.size or 0 for blob in blobs)
+        total_records = sum(len(records) for records, _ in parsed)
+        CORPUS_DOWNLOAD_SECONDS.observe(elapsed)
+        CORPUS_DOWNLOAD_BYTES.inc(total_bytes)
+        CORPUS_DOWNLOAD_RECORDS.inc(total_records)
+        logger.info(f"Downloaded {len(blobs)} blobs ({total_bytes / 1e6:.1f} MB, {total_records} records) "
+                    f"in {elapsed:.1f}s: {total_bytes / 1e6 / elapsed:.1f} MB/s, "
+                    f"{total_records / elapsed:.0f} records/s")
+        return {blob.name: (blob.generation, records, embeddings)
+                for blob, (records, embeddings) in zip(blobs, parsed)}
+
+    def start_background_refresh(self, interval: float):
+        """Refresh the corpus every interval seconds on a daemon thread."""
+        if interval <= 0 or self._thread is not None:
+            return
+
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.refresh()
+                    self.last_error = None
+                except Exception as e:
+                    self.last_error = str(e)
+                    logger.error(f"Corpus refresh failed: {str(e)}")
+
+        self._thread = threading.Thread(target=run, name='corpus-refresh', daemon=True)
+        self._thread.start()
+
+    def stats(self) -> Dict:
+        corpus = self._corpus
+        return {
+            'generation': corpus.generation if corpus else 0,
+            'blob_count': len(corpus.blobs) if corpus else 0,
+            'record_count': len(corpus.records) if corpus else 0,
+            'loaded_at': corpus.loaded_at.isoformat() if corpus else None,
+            'last_refresh': self.last_refresh.isoformat() if self.last_refresh else None,
+            'last_error': self.last_error,
+            'shared': self.shared is not None
+        }
@@ -17,12 +17,13 @@ import PyPDF2
 import re
 import json
 import uuid
-from datetime import datetime
-from google.cloud import aiplatform
-from vertexai.language_models import TextEmbeddingModel
-from datetime import datetime
 import os
+import argparse
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from clients import get_registry
+from downloads import prefetch
+from manifest import DONE, FAILED, IngestionManifest
 
 # Initialize Variables
 # Change your PROJECT_ID value here
@@ -33,16 +34,48 @@ location = "us-central1"
 bucket_name = "gcp-newsletter-rag-vertex2"
 # Change your  Google Cloud Storage Bucket Name   that store the source PDF files
 source_bucket_name = "knowedge-rag"
+# Ingestion state of the source PDFs, kept in the source bucket so it is not loaded as embeddings
+manifest_path = "manifests/embeddings_manifest.json"
+# Sentences per embedding request; each batch is embedded while the next pages are parsed
+embedding_batch_size = 5
 
 
-def extract_sentences_from_pdf_bytes(pdf_bytes):
-    reader = PyPDF2.PdfReader(pdf_bytes)
-    text = ""
+def iter_sentences_from_pdf(pdf_file):
+    """Yield the sentences of a PDF page by page, parsing each page once.
+
+    The unfinished sentence at the end of a page is carried over to the next one, so only
+    one page of text is held at a time. The sentences match splitting the concatenated
+    page texts on '. '.
+    """
+    reader = PyPDF2.PdfReader(pdf_file)
+    carry = ""
     for page in reader.pages:
-        if page.extract_text() is not None:
-            text += page.extract_text() + " "
-    sentences = [sentence.strip() for sentence in text.split('. ') if sentence.strip()]
-    return sentences
+        text = page.extract_text()
+        if text is None:
+            continue
+        parts = (carry + text + " ").split('. ')
+        carry = parts.pop()
+        for sentence in parts:
+            sentence = sentence.strip()
+            if sentence:
+                yield sentence
+    if carry.strip():
+        yield carry.strip()
+
+
+def extract_sentences_from_pdf_bytes(pdf_bytes):
+    return list(iter_sentences_from_pdf(pdf_bytes))
+
+
+def iter_batches(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
 
 def clean_text(text):
@@ -54,13 +87,65 @@ def clean_text(text):
 
 
 def generate_text_embeddings(sentences):
-    aiplatform.init(project=project, location=location)
-    model = TextEmbeddingModel.from_pretrained("textembedding-gecko@001")
+    model = get_registry(project, location).embedding_model()
     embeddings = model.get_embeddings(sentences)
     vectors = [embedding.values for embedding in embeddings]
     return vectors
 
 
+def write_embeddings(sentences, embed_file):
+    """Embed sentences batch by batch and write one JSON line per sentence.
+
+    The request for a batch runs in the background while the next batch is read from
+    sentences, so PDF parsing overlaps with the embedding calls. Returns the number of
+    lines written.
+    """
+    def write(batch, embeddings):
+        for sentence, embedding in zip(batch, embeddings):
+            embed_item = {"id": str(uuid.uuid4()), "sentence": clean_text(sentence), "embedding": embedding}
+            json.dump(embed_item, embed_file)
+            embed_file.write('\n')
+        return len(batch)
+
+    written = 0
+    pending = None
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        for batch in iter_batches(sentences, embedding_batch_size):
+            # At most one batch in flight while the next one is collected
+            if pending is not None:
+                written += write(pending[0], pending[1].result())
+            pending = (batch, executor.submit(generate_text_embeddings, batch))
+        if pending is not None:
+            written += write(pending[0], pending[1].result())
+    return written
+
+
+def embeddings_name(pdf_name):
+    """Name of the embeddings file a PDF is uploaded as in the target bucket."""
+    return os.path.basename(pdf_name.replace('.pdf', '_embeddings.json'))
+
+
+def seed_from_outputs(manifest, pdf_blobs, target_bucket_name):
+    """On the first run, record the PDFs whose embeddings are already in the target bucket.
+
+    Buckets embedded before the manifest existed then do not have every PDF embedded
+    again. An embeddings file older than its PDF does not count, so a PDF replaced
+    after it was embedded is still processed. Returns the seeded blobs.
+    """
+    if manifest.entries:
+        return []
+    storage_client = storage.Client()
+    outputs = {blob.name: blob for blob in storage_client.list_blobs(target_bucket_name)
+               if blob.name.endswith('_embeddings.json')}
+
+    def embedded(blob):
+        output = outputs.get(embeddings_name(blob.name))
+        if output is None:
+            return False
+        return not (blob.updated and output.updated) or output.updated >= blob.updated
+    return manifest.seed([blob for blob in pdf_blobs if embedded(blob)], 'embeddings')
+
+
 def upload_file(bucket_name, file_path):
     storage_client = storage.Client()
     bucket = storage_client.bucket(bucket_name)
@@ -69,37 +154,47 @@ def upload_file(bucket_name, file_path):
     print(f"File {file_path} uploaded to {bucket_name}.")
 
 
-def process_pdf_files_from_bucket(source_bucket_name, target_bucket_name):
+def process_pdf_files_from_bucket(source_bucket_name, target_bucket_name, baseline=False):
+    """Embed the PDFs that are new or changed since their last successful run.
+
+    With baseline, record every PDF as ingested without embedding it instead.
+    """
     storage_client = storage.Client()
-    today_str = datetime.now().strftime('%Y%m%d')
     prefix = ""  # Use this if your PDFs are stored under a specific prefix in the bucket
     blobs = storage_client.list_blobs(bucket_or_name=source_bucket_name, prefix=prefix)
+    pdf_blobs = [blob for blob in blobs if blob.name.endswith('.pdf')]
+
+    manifest = IngestionManifest(storage_client.bucket(source_bucket_name), manifest_path).load()
+    if baseline:
+        seeded = manifest.seed(pdf_blobs, 'baseline')
+        manifest.save()
+        print(f"Recorded {len(seeded)} PDFs as the ingestion baseline")
+        return
+    seeded = seed_from_outputs(manifest, pdf_blobs, target_bucket_name)
+    if seeded:
+        print(f"Seeded the manifest with {len(seeded)} PDFs whose embeddings already exist")
+    pending, skipped = manifest.partition(pdf_blobs)
+    print(f"{len(pending)} new or changed PDFs to process, {len(skipped)} unchanged skipped")
 
-    for blob in blobs:
-        # Construct the pattern to match files of the format xxxx_YYYYMMDD.pdf
-        pattern = f".*_{today_str}.pdf$"
-        if re.match(pattern, blob.name):
+    try:
+        # PDFs are downloaded into memory a few files ahead while earlier ones are embedded
+        for blob, download in prefetch(pending):
             print(f"Processing: {blob.name}")
-            blob.download_to_filename(blob.name)
-
-            with open(blob.name, 'rb') as pdf_file:
-                sentences = extract_sentences_from_pdf_bytes(pdf_file)
-
-            if sentences:
-                embeddings = generate_text_embeddings(sentences)
-                embed_file_path = blob.name.replace('.pdf', '_embeddings.json')
-
-                with open(embed_file_path, 'w') as embed_file:
-                    for sentence, embedding in zip(sentences, embeddings):
-                        cleaned_sentence = clean_text(sentence)
-                        id = str(uuid.uuid4())
-                        embed_item = {"id": id, "sentence": cleaned_sentence, "embedding": embedding}
-                        json.dump(embed_item, embed_file)
-                        embed_file.write('\n')
-
-                upload_file(target_bucket_name, embed_file_path)
-                os.remove(blob.name)  # Clean up downloaded PDF
-                os.remove(embed_file_path)  # Clean up generated embeddings file
+            embed_file_path = blob.name.replace('.pdf', '_embeddings.json')
+            try:
+                with download.result() as pdf_file, open(embed_file_path, 'w') as embed_file:
+                    written = write_embeddings(iter_sentences_from_pdf(pdf_file), embed_file)
+                if written:
+                    upload_file(target_bucket_name, embed_file_path)
+                manifest.mark(blob, DONE, sentences=written)
+            except Exception as e:
+                print(f"Error processing {blob.name}: {e}")
+                manifest.mark(blob, FAILED, error=str(e))
+            finally:
+                if os.path.exists(embed_file_path):
+                    os.remove(embed_file_path)  # Clean up generated embeddings file
+    finally:
+        manifest.save()
 
 
 def run_gcloud_command():
@@ -123,8 +218,15 @@ def run_gcloud_command():
         print(f"Error executing gcloud command: {e}")
 
 
-# Call the function to process PDF files
-process_pdf_files_from_bucket(source_bucket_name, bucket_name)
-# Call this function after process_pdf_files_from_bucket in your main logic
-# process_pdf_files_from_bucket(source_bucket_name, bucket_name)
-run_gcloud_command()
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Embed new or changed PDFs and update the index")
+    parser.add_argument('--baseline', action='store_true',
+                        help="record every PDF in the source bucket as already embedded, without embedding "
+                             "anything, e.g. for a bucket embedded before the manifest existed")
+    args = parser.parse_args()
+    # Call the function to process PDF files
+    process_pdf_files_from_bucket(source_bucket_name, bucket_name, baseline=args.baseline)
+    # Call this function after process_pdf_files_from_bucket in your main logic
+    # process_pdf_files_from_bucket(source_bucket_name, bucket_name)
+    if not args.baseline:
+        run_gcloud_command()
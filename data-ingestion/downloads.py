@@ -0,0 +1,62 @@
+# Copyright 2024 Google LLC
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#  https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# GCS downloads for ingestion without local file round-trips. Blobs are read into
+# memory (spilling to an anonymous temp file when large) and fetched a few at a
+# time ahead of the consumer, so downloads overlap with PDF parsing.
+
+import os
+import tempfile
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, IO, Iterable, Iterator, Tuple
+
+# Blobs up to this size are held in memory, larger ones spill to disk
+SPOOL_THRESHOLD = int(os.environ.get('DOWNLOAD_SPOOL_THRESHOLD', str(32 * 1024 * 1024)))
+# Downloads running ahead of the consumer
+PREFETCH_DEPTH = int(os.environ.get('DOWNLOAD_PREFETCH_DEPTH', '4'))
+
+
+def download_to_buffer(blob, spool_threshold: int = SPOOL_THRESHOLD) -> IO[bytes]:
+    """Download a blob into a file object positioned at its start; the caller closes it."""
+    buffer = tempfile.SpooledTemporaryFile(max_size=spool_threshold)
+    try:
+        blob.download_to_file(buffer)
+    except Exception:
+        buffer.close()
+        raise
+    buffer.seek(0)
+    return buffer
+
+
+def prefetch(blobs: Iterable, fetch: Callable = download_to_buffer,
+             depth: int = PREFETCH_DEPTH) -> Iterator[Tuple[object, Future]]:
+    """Yield (blob, future of fetch(blob)) in order, with up to depth fetches running ahead.
+
+    At most depth fetched results wait for the consumer at any time. A failed fetch
+    raises from its future's result(), so the consumer can handle each blob on its own.
+    """
+    blobs = iter(blobs)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=max(1, depth), thread_name_prefix='prefetch') as executor:
+        for blob in blobs:
+            pending.append((blob, executor.submit(fetch, blob)))
+            if len(pending) >= depth:
+                break
+        while pending:
+            blob, future = pending.popleft()
+            # Keep depth downloads running while the consumer works on this one
+            for next_blob in blobs:
+                pending.append((next_blob, executor.submit(fetch, next_blob)))
+                break
+            yield blob, future
@@ -1,14 +1,36 @@
-from google.cloud import aiplatform
 from google.cloud import storage
 import json
+import hashlib
 import logging
 from typing import List, Dict
 from datetime import datetime
 import os
+from clients import get_registry, EMBEDDING_MODEL_NAME
+from filters import filter_values, to_restricts
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+
+def to_datapoint(chunk: Dict, embedding: List[float]) -> Dict:
+    """Build the Vector Search datapoint for a chunk.
+
+    The chunk's document type, year and municipality become restricts, so queries can
+    be filtered on them, and are also kept as plain fields for local filtering.
+    """
+    metadata = chunk.get('metadata', {})
+    source = metadata.get('source') or metadata.get('filename', '')
+    position = metadata.get('page', metadata.get('chunk_index', 0))
+    # Stable IDs so reprocessing a document overwrites its datapoints
+    datapoint = {
+        'id': hashlib.sha1(f"{source}#{position}".encode('utf-8')).hexdigest(),
+        'text': chunk['text'],
+        'embedding': embedding,
+        'restricts': to_restricts(metadata)
+    }
+    datapoint.update(filter_values(metadata))
+    return datapoint
+
 class EmbeddingGenerator:
     def __init__(self,
                  project_id: str = "panda-17d82",
@@ -20,10 +42,12 @@ class EmbeddingGenerator:
         self.bucket_name = bucket_name
         self.storage_client = storage.Client()
         self.bucket = self.storage_client.bucket(bucket_name)
-        aiplatform.init(project=project_id, location=location)
-        self.embedding_model = aiplatform.TextEmbeddingModel.from_pretrained(
-            "textembedding-gecko@001"
-        )
+        self.clients = get_registry(project_id, location)
+
+    @property
+    def embedding_model(self):
+        """Shared embedding model handle for this project."""
+        return self.clients.embedding_model()
 
     def generate_embeddings(self, texts: List[str]) -> List[List[float]]:
         """Generate embeddings for a list of texts."""
@@ -51,7 +75,7 @@ class EmbeddingGenerator:
                 'embeddings': embeddings,
                 'metadata': {
                     'processed_at': datetime.utcnow().isoformat(),
-                    'model': 'textembedding-gecko@001',
+                    'model': EMBEDDING_MODEL_NAME,
                     'source_file': chunks_file
                 }
             }
@@ -67,6 +91,15 @@ class EmbeddingGenerator:
             )
             
             logger.info(f"Saved embeddings to {output_path}")
+
+            # Index-ready JSONL datapoints with filterable restricts
+            datapoints_path = f'datapoints/municipal_datapoints_{timestamp}.json'
+            self.bucket.blob(datapoints_path).upload_from_string(
+                "\n".join(json.dumps(to_datapoint(chunk, embedding))
+                          for chunk, embedding in zip(chunks, embeddings)),
+                content_type='application/json'
+            )
+            logger.info(f"Saved datapoints to {datapoints_path}")
             return output_path
             
         except Exception as e:
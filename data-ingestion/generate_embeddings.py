@@ -1,9 +1,10 @@
-from google.cloud import aiplatform
 import json
 import os
 from typing import List, Dict
 from datetime import datetime
 import time
+from clients import get_registry, EMBEDDING_MODEL_NAME
+from embedding_generator import to_datapoint
 
 def batch_generator(items: List, batch_size: int):
     """Generate batches from a list."""
@@ -12,8 +13,7 @@ def batch_generator(items: List, batch_size: int):
 
 def generate_embeddings(texts: List[str], batch_size: int = 5) -> List[List[float]]:
     """Generate embeddings in batches."""
-    aiplatform.init(project='panda-17d82', location='us-central1')
-    model = aiplatform.TextEmbeddingModel.from_pretrained("textembedding-gecko@001")
+    model = get_registry('panda-17d82', 'us-central1').embedding_model()
     
     all_embeddings = []
     for batch in batch_generator(texts, batch_size):
@@ -49,11 +49,17 @@ def main():
                         'chunks': chunks,
                         'embeddings': embeddings,
                         'metadata': {
-                            'model': 'textembedding-gecko@001',
+                            'model': EMBEDDING_MODEL_NAME,
                             'processed_at': datetime.utcnow().isoformat()
                         }
                     }, f, indent=2)
                 
+                # Index-ready datapoints with filterable restricts, one JSON object per line
+                datapoints_file = os.path.join(embeddings_dir, f"{filename}_datapoints.json")
+                with open(datapoints_file, 'w') as f:
+                    for chunk, embedding in zip(chunks, embeddings):
+                        f.write(json.dumps(to_datapoint(chunk, embedding)) + '\n')
+                
                 print(f"Generated embeddings for {filename}: {len(embeddings)} vectors")
                 
             except Exception as e:
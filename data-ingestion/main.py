@@ -5,15 +5,18 @@
 #
 #  https://www.apache.org/licenses/LICENSE-2.0
 
-from flask import Flask, request, jsonify
-from google.cloud import aiplatform
+from flask import Flask, Response, request, jsonify
 from google.cloud import storage
 import os
 import json
 import logging
 from datetime import datetime
 from municipal_processor import MunicipalDocumentProcessor
+from manifest import IngestionManifest
 from embedding_generator import EmbeddingGenerator
+from clients import get_registry
+from filters import parse_filters, to_namespaces
+from metrics import CONTENT_TYPE_LATEST, generate_latest, stage_timer, track_request
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -26,6 +29,11 @@ PROJECT_ID = "panda-17d82"
 LOCATION = "us-central1"
 BUCKET_NAME = "panda-17d82-municipal-data"
 INDEX_ID = "municipal-docs-index"
+# /query searches the index through the endpoint it is deployed on
+INDEX_ENDPOINT_NAME = os.environ.get('INDEX_ENDPOINT_NAME', 'municipal-docs-endpoint')
+DEPLOYED_INDEX_ID = os.environ.get('DEPLOYED_INDEX_ID', 'municipal_docs_index')
+# Processes parsing PDFs in /process-documents (0 = one per core)
+PARSE_WORKERS = int(os.environ.get('PARSE_WORKERS', '0'))
 
 # Initialize processors
 doc_processor = MunicipalDocumentProcessor(
@@ -45,23 +53,53 @@ def health_check():
     """Health check endpoint."""
     return jsonify({"status": "healthy", "timestamp": datetime.utcnow().isoformat()})
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Expose Prometheus metrics."""
+    return Response(generate_latest(), mimetype=CONTENT_TYPE_LATEST)
+
 @app.route('/process-documents', methods=['POST'])
+@track_request('/process-documents')
 def process_documents():
     """Endpoint to trigger document processing."""
     try:
         data = request.get_json()
         prefix = data.get('prefix', 'esquimalt_data/pdfs/')
+        # Only new or changed PDFs are processed unless {"incremental": false}
+        incremental = data.get('incremental', True)
+        if data.get('baseline'):
+            # Bootstrap the manifest of a bucket ingested before it existed: record the
+            # PDFs as ingested without processing them
+            with stage_timer('record_baseline'):
+                baseline = doc_processor.record_baseline(prefix)
+            return jsonify({"status": "success", "processed_documents": 0,
+                            "baseline_documents": len(baseline)})
         
         # Process documents
-        chunks = doc_processor.process_directory(prefix)
-        chunks_file = doc_processor.save_chunks(chunks)
+        with stage_timer('process_directory'):
+            run = doc_processor.process_directory(prefix, workers=PARSE_WORKERS or None,
+                                                  incremental=incremental)
+        chunks = run.chunks
+        summary = {
+            "parsed_documents": len(run.parsed),
+            "skipped_documents": len(run.skipped),
+            "failed_documents": sorted(blob.name for blob in run.errors)
+        }
+        if not chunks:
+            doc_processor.record_ingested(run)
+            return jsonify({"status": "success", "processed_documents": 0, **summary})
+        with stage_timer('save_chunks'):
+            chunks_file = doc_processor.save_chunks(chunks)
         
         # Generate embeddings
-        embeddings_file = embedding_gen.process_chunks(chunks_file)
+        with stage_timer('generate_embeddings'):
+            embeddings_file = embedding_gen.process_chunks(chunks_file)
+        doc_processor.record_ingested(run)
         
         return jsonify({
             "status": "success",
             "processed_documents": len(chunks),
+            **summary,
             "chunks_file": chunks_file,
             "embeddings_file": embeddings_file
         })
@@ -74,6 +112,7 @@ def process_documents():
         }), 500
 
 @app.route('/query', methods=['POST'])
+@track_request('/query')
 def query_documents():
     """Endpoint to query the vector index."""
     try:
@@ -81,30 +120,38 @@ def query_documents():
         query = data.get('query')
         if not query:
             return jsonify({"error": "No query provided"}), 400
+        try:
+            # e.g. {"document_type": "minutes", "year": [2022, 2023]}
+            filters = parse_filters(data.get('filters'))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
         
-        # Initialize Vertex AI
-        aiplatform.init(project=PROJECT_ID, location=LOCATION)
-        
-        # Get the index
-        index = aiplatform.MatchingEngineIndex(index_id=INDEX_ID)
+        # Get the index endpoint (shared handle, built once per process); an index
+        # can only be queried through the endpoint it is deployed on
+        index_endpoint = get_registry(PROJECT_ID, LOCATION).index_endpoint(INDEX_ENDPOINT_NAME)
         
-        # Query the index
-        response = index.find_neighbors(
-            query_vectors=[query],
-            num_neighbors=5
-        )
+        # Query the index; filters match the restricts attached to each datapoint
+        with stage_timer('embed'):
+            query_vector = embedding_gen.generate_embeddings([query])[0]
+        with stage_timer('find_neighbors'):
+            response = index_endpoint.find_neighbors(
+                deployed_index_id=DEPLOYED_INDEX_ID,
+                queries=[query_vector],
+                num_neighbors=5,
+                filter=to_namespaces(filters) if filters else None
+            )
         
-        # Format results
+        # Format results; a match carries the datapoint ID and its distance only
         results = []
         for neighbor in response[0]:
             results.append({
-                "text": neighbor.text,
-                "metadata": neighbor.metadata,
+                "id": neighbor.id,
                 "score": float(neighbor.distance)
             })
         
         return jsonify({
             "query": query,
+            "filters": filters,
             "results": results
         })
     
@@ -131,6 +178,7 @@ def get_stats():
             "total_pdfs": pdf_count,
             "processed_documents": processed_count,
             "embedding_files": embeddings_count,
+            "manifest": IngestionManifest(bucket).load().stats(),
             "last_updated": datetime.utcnow().isoformat()
         })
     
@@ -0,0 +1,131 @@
+# Copyright 2024 Google LLC
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#  https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import logging
+import threading
+from datetime import datetime
+from typing import Dict, Iterable, List, Tuple
+
+from google.api_core.exceptions import PreconditionFailed
+
+logger = logging.getLogger(__name__)
+
+DONE = 'done'
+FAILED = 'failed'
+
+
+class IngestionManifest:
+    """Ingestion state per source blob, persisted as one JSON object in GCS.
+
+    Each entry records the blob generation and MD5 hash it was ingested at and its
+    status. A blob is unchanged if its generation matches, or if it was re-uploaded
+    with the same content; only unchanged blobs whose last ingestion succeeded are
+    skipped. Saving is conditional on the manifest generation that was loaded, and
+    merges with entries written concurrently by another run.
+    """
+
+    def __init__(self, bucket, path: str = 'manifests/ingestion_manifest.json', max_attempts: int = 5):
+        self.bucket = bucket
+        self.path = path
+        self.max_attempts = max_attempts
+        self.entries: Dict[str, Dict] = {}
+        self._updated: Dict[str, Dict] = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def load(self) -> 'IngestionManifest':
+        blob = self.bucket.get_blob(self.path)
+        with self._lock:
+            if blob is None:
+                self.entries, self._generation = {}, 0
+            else:
+                self.entries = json.loads(blob.download_as_bytes())
+                self._generation = blob.generation
+            # Entries marked but not saved yet win over the stored ones
+            self.entries.update(self._updated)
+        return self
+
+    def is_current(self, blob) -> bool:
+        """Whether blob was ingested successfully and has not changed since."""
+        entry = self.entries.get(blob.name)
+        if entry is None or entry['status'] != DONE:
+            return False
+        if entry['generation'] == blob.generation:
+            return True
+        if blob.md5_hash and entry.get('md5') == blob.md5_hash:
+            # Same content uploaded again: remember the new generation, nothing to ingest
+            self.mark(blob, DONE)
+            return True
+        return False
+
+    def partition(self, blobs: Iterable) -> Tuple[List, List]:
+        """Split blobs into (new or changed, unchanged)."""
+        pending, skipped = [], []
+        for blob in blobs:
+            (skipped if self.is_current(blob) else pending).append(blob)
+        return pending, skipped
+
+    def seed(self, blobs: Iterable, source: str) -> List:
+        """Record blobs without an entry as ingested, without processing them.
+
+        Bootstraps the manifest of a bucket that was ingested before the manifest
+        existed, so the first incremental run does not redo the whole corpus; source
+        says what the entries were seeded from. Returns the blobs that were added.
+        """
+        seeded = [blob for blob in blobs if blob.name not in self.entries]
+        for blob in seeded:
+            self.mark(blob, DONE, seeded_from=source)
+        return seeded
+
+    def mark(self, blob, status: str, **details):
+        entry = {
+            'generation': blob.generation,
+            'md5': blob.md5_hash,
+            'status': status,
+            'updated_at': datetime.utcnow().isoformat(),
+            **details
+        }
+        with self._lock:
+            self.entries[blob.name] = entry
+            self._updated[blob.name] = entry
+
+    def save(self):
+        """Write the entries marked since the last save."""
+        for _ in range(self.max_attempts):
+            with self._lock:
+                if not self._updated:
+                    return
+                updated, generation = dict(self._updated), self._generation
+                payload = json.dumps(self.entries, indent=2)
+            target = self.bucket.blob(self.path)
+            try:
+                target.upload_from_string(payload, content_type='application/json',
+                                          if_generation_match=generation)
+            except PreconditionFailed:
+                # Another run saved in between: merge with its entries and try again
+                logger.info(f"Manifest {self.path} changed concurrently, merging")
+                self.load()
+                continue
+            with self._lock:
+                self._generation = target.generation
+                for name, entry in updated.items():
+                    if self._updated.get(name) is entry:
+                        del self._updated[name]
+            logger.info(f"Saved manifest {self.path}: {len(updated)} updated entries")
+            return
+        raise RuntimeError(f"Could not save manifest {self.path} after {self.max_attempts} attempts")
+
+    def stats(self) -> Dict:
+        statuses = [entry['status'] for entry in self.entries.values()]
+        return {'documents': len(statuses), 'done': statuses.count(DONE), 'failed': statuses.count(FAILED)}
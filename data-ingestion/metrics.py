@@ -0,0 +1,183 @@
+# Copyright 2024 Google LLC
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#  https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This module is mirrored in the top-level metrics.py because the serving app
+# and the ingestion service are built as separate container images.
+
+import time
+import asyncio
+import functools
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Optional
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+)
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+# Remote calls range from sub-millisecond local lookups to multi-second LLM calls
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+STAGE_LATENCY = Histogram('stage_latency_seconds', 'Latency of each request stage',
+                          ['stage'], buckets=LATENCY_BUCKETS)
+STAGE_ERRORS = Counter('stage_errors_total', 'Errors raised by each request stage', ['stage'])
+REQUEST_LATENCY = Histogram('request_latency_seconds', 'End-to-end latency per endpoint',
+                            ['endpoint'], buckets=LATENCY_BUCKETS)
+REQUESTS_IN_FLIGHT = Gauge('requests_in_flight', 'Requests currently being handled', ['endpoint'])
+
+# Prompt sections range from a few tokens of history to several thousand of context
+TOKEN_BUCKETS = (0, 50, 100, 250, 500, 1000, 1500, 2000, 3000, 4000, 6000, 8000, 16000, 32000)
+
+PROMPT_TOKENS = Histogram('prompt_tokens', 'Tokens in each section of a generation prompt',
+                          ['section'], buckets=TOKEN_BUCKETS)
+
+
+@contextmanager
+def stage_timer(stage: str):
+    """Time a block as one stage and count it as an error if it raises."""
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_ERRORS.labels(stage).inc()
+        raise
+    finally:
+        STAGE_LATENCY.labels(stage).observe(time.perf_counter() - started)
+
+
+class _RequestTimer:
+    """Latency and in-flight tracking of one request, finished exactly once."""
+
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        self.streaming = False
+        self._started = time.perf_counter()
+        self._finished = False
+        self._lock = threading.Lock()
+        REQUESTS_IN_FLIGHT.labels(endpoint).inc()
+
+    def finish(self):
+        with self._lock:
+            if self._finished:
+                return
+            self._finished = True
+        REQUEST_LATENCY.labels(self.endpoint).observe(time.perf_counter() - self._started)
+        REQUESTS_IN_FLIGHT.labels(self.endpoint).dec()
+
+
+_current_request: "contextvars.ContextVar[Optional[_RequestTimer]]" = \
+    contextvars.ContextVar('request_timer', default=None)
+
+
+def track_request(endpoint: str):
+    """Decorate a (sync or async) view to record its latency and in-flight count.
+
+    A view that streams its body wraps the body in tracked_stream(), so the request
+    is only finished once the stream is.
+    """
+    def decorator(view):
+        if asyncio.iscoroutinefunction(view):
+            @functools.wraps(view)
+            async def async_wrapper(*args, **kwargs):
+                timer = _RequestTimer(endpoint)
+                token = _current_request.set(timer)
+                try:
+                    return await view(*args, **kwargs)
+                finally:
+                    _current_request.reset(token)
+                    if not timer.streaming:
+                        timer.finish()
+            return async_wrapper
+
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            timer = _RequestTimer(endpoint)
+            token = _current_request.set(timer)
+            try:
+                response = view(*args, **kwargs)
+            except BaseException:
+                timer.finish()
+                raise
+            finally:
+                _current_request.reset(token)
+            if not timer.streaming:
+                timer.finish()
+            elif hasattr(response, 'call_on_close'):
+                # Also covers a client that disconnects before the stream starts
+                response.call_on_close(timer.finish)
+            return response
+        return wrapper
+    return decorator
+
+
+def tracked_stream(body):
+    """Wrap a view's (sync or async) response generator so the latency recorded by
+    track_request covers the whole stream rather than just the headers."""
+    timer = _current_request.get()
+    if timer is None:
+        return body
+    timer.streaming = True
+    if hasattr(body, '__aiter__'):
+        async def async_stream():
+            try:
+                async for item in body:
+                    yield item
+            finally:
+                timer.finish()
+        return async_stream()
+
+    def stream():
+        try:
+            yield from body
+        finally:
+            timer.finish()
+    return stream()
+
+
+class StatsCollector:
+    """Expose the numeric values of a stats() dict at scrape time."""
+
+    def __init__(self, name: str, stats_fn: Callable[[], Dict], counters: Iterable[str] = ()):
+        self.name = name
+        self.stats_fn = stats_fn
+        self.counters = set(counters)
+
+    def describe(self):
+        # Without describe() the registry calls collect() at registration time, which
+        # would build whatever stats_fn reports on (e.g. the lexical index) at import
+        return []
+
+    def collect(self):
+        for key, value in self.stats_fn().items():
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            metric_name = f"{self.name}_{key}"
+            if key in self.counters:
+                yield CounterMetricFamily(metric_name, f"{self.name} {key}", value=value)
+            else:
+                yield GaugeMetricFamily(metric_name, f"{self.name} {key}", value=value)
+
+
+def register_stats(name: str, stats_fn: Callable[[], Dict], counters: Iterable[str] = ()):
+    """Publish a component's stats() counters and gauges under the given metric prefix."""
+    collector = StatsCollector(name, stats_fn, counters)
+    REGISTRY.register(collector)
+    return collector
@@ -1,16 +1,72 @@
 from google.cloud import storage
-from google.cloud import aiplatform
+from collections import namedtuple
 from typing import List, Dict, Optional
 import PyPDF2
 import json
+import io
 import os
 import logging
 from datetime import datetime
+from functools import lru_cache
+from clients import get_registry
+from manifest import DONE, FAILED, IngestionManifest
+from downloads import PREFETCH_DEPTH, SPOOL_THRESHOLD, download_to_buffer, prefetch
+from parallel import map_files
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+
+def extract_page_chunks(pdf_file, metadata: Dict) -> List[Dict]:
+    """Split an open PDF into one chunk per non-empty page."""
+    pdf_reader = PyPDF2.PdfReader(pdf_file)
+    total_pages = len(pdf_reader.pages)
+    chunks = []
+    for page_num, page in enumerate(pdf_reader.pages):
+        text = page.extract_text()
+        if text and text.strip():  # Only process non-empty pages
+            chunks.append({
+                'text': text,
+                'metadata': {
+                    **metadata,
+                    'page': page_num + 1,
+                    'total_pages': total_pages,
+                    'processed_at': datetime.utcnow().isoformat()
+                }
+            })
+    return chunks
+
+
+@lru_cache(maxsize=None)
+def _worker_bucket(bucket_name: str):
+    # One storage client per worker process
+    return storage.Client().bucket(bucket_name)
+
+
+def process_blob(bucket_name: str, blob_name: str, metadata: Dict, data: Optional[bytes] = None) -> List[Dict]:
+    """Split one PDF; runs in the parsing worker processes.
+
+    data holds the prefetched PDF. Without it (large or failed prefetch) the worker
+    downloads the blob itself.
+    """
+    if data is not None:
+        return extract_page_chunks(io.BytesIO(data), metadata)
+    with download_to_buffer(_worker_bucket(bucket_name).blob(blob_name)) as pdf_file:
+        return extract_page_chunks(pdf_file, metadata)
+
+
+def _prefetch_pdf(blob) -> Optional[bytes]:
+    # Large PDFs are left to the worker, which spools them to disk instead of memory
+    return blob.download_as_bytes() if (blob.size or 0) <= SPOOL_THRESHOLD else None
+
+
+# Outcome of one process_directory call: the chunks, the PDF blobs parsed successfully,
+# the failed blobs with their errors, the names of unchanged PDFs that were skipped and
+# the manifest the run was planned against
+DirectoryRun = namedtuple('DirectoryRun', ['chunks', 'parsed', 'errors', 'skipped', 'manifest'])
+
+
 class MunicipalDocumentProcessor:
     def __init__(self, 
                  project_id: str = "panda-17d82",
@@ -24,35 +80,15 @@ class MunicipalDocumentProcessor:
         self.index_id = index_id
         self.storage_client = storage.Client()
         self.bucket = self.storage_client.bucket(bucket_name)
-        aiplatform.init(project=project_id, location=location)
+        self.clients = get_registry(project_id, location)
+        self.clients.ensure_initialized()
         
     def process_pdf(self, blob_name: str) -> List[Dict]:
         """Process a single PDF from GCS into chunks with metadata."""
         try:
             blob = self.bucket.blob(blob_name)
-            tmp_path = f"/tmp/{os.path.basename(blob_name)}"
-            blob.download_to_filename(tmp_path)
-            
-            chunks = []
-            with open(tmp_path, 'rb') as file:
-                pdf_reader = PyPDF2.PdfReader(file)
-                metadata = self._extract_metadata(blob_name)
-                
-                for page_num in range(len(pdf_reader.pages)):
-                    text = pdf_reader.pages[page_num].extract_text()
-                    if text.strip():  # Only process non-empty pages
-                        chunks.append({
-                            'text': text,
-                            'metadata': {
-                                **metadata,
-                                'page': page_num + 1,
-                                'total_pages': len(pdf_reader.pages),
-                                'processed_at': datetime.utcnow().isoformat()
-                            }
-                        })
-            
-            os.remove(tmp_path)  # Cleanup
-            return chunks
+            with download_to_buffer(blob) as pdf_file:
+                return extract_page_chunks(pdf_file, self._extract_metadata(blob_name))
             
         except Exception as e:
             logger.error(f"Error processing {blob_name}: {str(e)}")
@@ -92,23 +128,69 @@ class MunicipalDocumentProcessor:
         except:
             return None
 
-    def process_directory(self, prefix: str = 'esquimalt_data/pdfs/') -> List[Dict]:
-        """Process all PDFs in a directory."""
-        all_chunks = []
-        blobs = self.bucket.list_blobs(prefix=prefix)
-        
-        for blob in blobs:
-            if blob.name.endswith('.pdf'):
-                logger.info(f"Processing {blob.name}")
+    def process_directory(self, prefix: str = 'esquimalt_data/pdfs/',
+                          workers: Optional[int] = None, incremental: bool = True) -> 'DirectoryRun':
+        """Process the PDFs in a directory.
+
+        With incremental, only PDFs that are new or changed since their last successful
+        ingestion are processed; pass the returned run to record_ingested() once its
+        chunks are stored.
+        PDF parsing is CPU-bound, so the files are split across a process pool with
+        workers processes (default: one per core; 1 parses them in this process).
+        A file that fails is logged and skipped. Chunks keep the listing order.
+        PDFs are downloaded into memory a few files ahead of the parsers.
+        """
+        blobs = [blob for blob in self.bucket.list_blobs(prefix=prefix) if blob.name.endswith('.pdf')]
+        # Each run works on its own manifest copy; saves merge with concurrent runs
+        manifest = IngestionManifest(self.bucket).load()
+        skipped = []
+        if incremental:
+            blobs, skipped = manifest.partition(blobs)
+            logger.info(f"{len(blobs)} new or changed PDFs, skipping {len(skipped)} unchanged")
+
+        def tasks():
+            for blob, download in prefetch(blobs, _prefetch_pdf, PREFETCH_DEPTH):
                 try:
-                    chunks = self.process_pdf(blob.name)
-                    all_chunks.extend(chunks)
-                    logger.info(f"Successfully processed {blob.name}: {len(chunks)} chunks")
+                    data = download.result()
                 except Exception as e:
-                    logger.error(f"Failed to process {blob.name}: {str(e)}")
-                    continue
+                    logger.warning(f"Prefetching {blob.name} failed, the worker retries it: {str(e)}")
+                    data = None
+                yield blob.name, (self.bucket_name, blob.name, self._extract_metadata(blob.name), data)
+
+        results, errors = map_files(process_blob, tasks(), workers, label='PDFs', total=len(blobs))
+        by_name = {blob.name: blob for blob in blobs}
         
-        return all_chunks
+        all_chunks = []
+        for blob_name, chunks in results.items():
+            logger.info(f"Successfully processed {blob_name}: {len(chunks)} chunks")
+            all_chunks.extend(chunks)
+        return DirectoryRun(all_chunks, [by_name[blob_name] for blob_name in results],
+                            {by_name[blob_name]: error for blob_name, error in errors.items()},
+                            [blob.name for blob in skipped], manifest)
+
+    def record_baseline(self, prefix: str = 'esquimalt_data/pdfs/') -> List[str]:
+        """Record the PDFs under prefix that have no manifest entry as ingested, without
+        processing them, and save the manifest.
+
+        For a bucket whose PDFs were ingested before the manifest existed: the next
+        incremental run then only processes PDFs added or changed after the baseline.
+        Returns the names of the PDFs that were recorded.
+        """
+        blobs = [blob for blob in self.bucket.list_blobs(prefix=prefix) if blob.name.endswith('.pdf')]
+        manifest = IngestionManifest(self.bucket).load()
+        seeded = manifest.seed(blobs, 'baseline')
+        manifest.save()
+        logger.info(f"Recorded {len(seeded)} PDFs under {prefix} as the ingestion baseline")
+        return [blob.name for blob in seeded]
+
+    def record_ingested(self, run: 'DirectoryRun'):
+        """Mark the PDFs parsed in a process_directory run as ingested and save its
+        manifest; failed PDFs stay pending and are retried by the next run."""
+        for blob in run.parsed:
+            run.manifest.mark(blob, DONE)
+        for blob, error in run.errors.items():
+            run.manifest.mark(blob, FAILED, error=error)
+        run.manifest.save()
 
     def save_chunks(self, chunks: List[Dict], output_prefix: str = 'processed/'):
         """Save processed chunks to GCS."""
@@ -0,0 +1,98 @@
+# Copyright 2024 Google LLC
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#  https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import logging
+import multiprocessing
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+
+def default_workers() -> int:
+    """Worker processes for CPU-bound parsing: one per available core."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # not available on macOS
+        return os.cpu_count() or 1
+
+
+def map_files(fn: Callable, tasks: Union[Dict[str, tuple], Iterable[Tuple[str, tuple]]],
+              workers: Optional[int] = None, label: str = 'files',
+              total: Optional[int] = None) -> Tuple[Dict[str, Any], Dict[str, str]]:
+    """Run fn(*args) for every keyed task, spread over a process pool.
+
+    tasks is a dict of key -> args or an iterable of (key, args) pairs; an iterable is
+    consumed lazily, with at most two tasks per worker submitted ahead, so its
+    arguments can be produced (e.g. downloaded) while earlier tasks are parsed.
+    fn must be a module-level function so it can be sent to the workers. A task that
+    raises only lands in the returned errors, the other tasks carry on. Results and
+    errors are keyed and ordered like tasks. With workers <= 1 the tasks run in
+    this process.
+    """
+    if isinstance(tasks, dict):
+        total = len(tasks)
+        tasks = tasks.items()
+    workers = workers or default_workers()
+    if total is not None:
+        workers = min(workers, total)
+    keys, outcomes, errors = [], {}, {}
+    # Log roughly every 5% of the files
+    log_every = max(1, (total or 0) // 20)
+
+    def finished(key, error=None):
+        if error is not None:
+            logger.error(f"Failed to process {key}: {str(error)}")
+            errors[key] = str(error)
+        done = len(outcomes) + len(errors)
+        if done % log_every == 0 or done == total:
+            logger.info(f"Processed {done}/{total if total is not None else '?'} {label} "
+                        f"({len(errors)} failed)")
+
+    if workers <= 1:
+        for key, args in tasks:
+            keys.append(key)
+            try:
+                outcomes[key] = fn(*args)
+            except Exception as e:
+                finished(key, e)
+            else:
+                finished(key)
+    else:
+        # Spawned workers do not inherit the parent's client threads and connections
+        with ProcessPoolExecutor(max_workers=workers,
+                                 mp_context=multiprocessing.get_context('spawn')) as executor:
+            futures = {}
+
+            def collect(return_when):
+                done, _ = wait(futures, return_when=return_when)
+                for future in done:
+                    key = futures.pop(future)
+                    try:
+                        outcomes[key] = future.result()
+                    except Exception as e:
+                        finished(key, e)
+                    else:
+                        finished(key)
+
+            for key, args in tasks:
+                keys.append(key)
+                futures[executor.submit(fn, *args)] = key
+                if len(futures) >= 2 * workers:
+                    collect(FIRST_COMPLETED)
+            collect(ALL_COMPLETED)
+
+    results = {key: outcomes[key] for key in keys if key in outcomes}
+    errors = {key: errors[key] for key in keys if key in errors}
+    return results, errors
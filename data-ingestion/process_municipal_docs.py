@@ -1,10 +1,10 @@
-from google.cloud import storage
 import os
 import json
 import PyPDF2
 import re
 from datetime import datetime
-from typing import List, Dict
+from typing import List, Dict, Optional
+from parallel import map_files
 
 def extract_metadata(filename: str) -> Dict:
     """Extract metadata from filename."""
@@ -48,7 +48,10 @@ def chunk_text(text: str, chunk_size: int = 1000, overlap: int = 100) -> List[st
                 end = start + chunk_size
         
         chunks.append(text[start:end])
-        start = end - overlap
+        if end >= text_len:
+            break
+        # Step back by the overlap, but always move forward
+        start = max(end - overlap, start + 1)
     
     return chunks
 
@@ -82,31 +85,37 @@ def process_pdf(file_path: str) -> List[Dict]:
             
     except Exception as e:
         print(f"Error processing {file_path}: {str(e)}")
+        # Let the caller key and report the failure
+        raise
     
     return chunks
 
-def main():
+def main(workers: Optional[int] = None):
+    """Parse every PDF in the input directory, spread over workers processes
+    (default: one per core)."""
     input_dir = 'data/municipal_docs'
     output_dir = 'data/processed'
     os.makedirs(output_dir, exist_ok=True)
     
+    tasks = {filename: (os.path.join(input_dir, filename),)
+             for filename in os.listdir(input_dir) if filename.endswith('.pdf')}
+    results, errors = map_files(process_pdf, tasks, workers, label='PDFs')
+    
     all_chunks = []
-    for filename in os.listdir(input_dir):
-        if filename.endswith('.pdf'):
-            file_path = os.path.join(input_dir, filename)
-            chunks = process_pdf(file_path)
-            all_chunks.extend(chunks)
-            
-            # Save chunks for this file
-            output_file = os.path.join(output_dir, f"{filename}.json")
-            with open(output_file, 'w') as f:
-                json.dump(chunks, f, indent=2)
+    for filename, chunks in results.items():
+        all_chunks.extend(chunks)
+        
+        # Save chunks for this file
+        output_file = os.path.join(output_dir, f"{filename}.json")
+        with open(output_file, 'w') as f:
+            json.dump(chunks, f, indent=2)
     
     # Save summary
     with open(os.path.join(output_dir, '_summary.json'), 'w') as f:
         json.dump({
             'total_documents': len(os.listdir(input_dir)),
             'total_chunks': len(all_chunks),
+            'failed_documents': sorted(errors),
             'processed_at': datetime.utcnow().isoformat()
         }, f, indent=2)
 
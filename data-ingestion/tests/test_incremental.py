@@ -0,0 +1,120 @@
+import io
+from datetime import datetime
+from unittest import mock
+
+import PyPDF2
+import pytest
+from google.api_core.exceptions import PreconditionFailed
+
+
+def make_pdf():
+    writer = PyPDF2.PdfWriter()
+    writer.add_blank_page(width=200, height=200)
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue()
+
+
+class FakeBlob:
+    def __init__(self, bucket, name, data=b'', generation=0):
+        self.bucket, self.name, self.data, self.generation = bucket, name, data, generation
+        self.size = len(data)
+        self.md5_hash = str(hash(data))
+
+    def download_as_bytes(self):
+        return self.data
+
+    def download_to_file(self, file):
+        file.write(self.data)
+
+    def upload_from_string(self, payload, content_type=None, if_generation_match=None):
+        current = self.bucket.blobs.get(self.name)
+        if (current.generation if current else 0) != if_generation_match:
+            raise PreconditionFailed('generation mismatch')
+        self.data = payload.encode() if isinstance(payload, str) else payload
+        self.generation = (current.generation if current else 0) + 1
+        self.bucket.blobs[self.name] = FakeBlob(self.bucket, self.name, self.data, self.generation)
+
+
+class FakeBucket:
+    def __init__(self):
+        self.blobs = {}
+
+    def add(self, name, data):
+        self.blobs[name] = FakeBlob(self, name, data, generation=len(self.blobs) + 1)
+
+    def list_blobs(self, prefix=''):
+        return [blob for name, blob in sorted(self.blobs.items()) if name.startswith(prefix)]
+
+    def get_blob(self, name):
+        return self.blobs.get(name)
+
+    def blob(self, name):
+        return self.blobs.get(name) or FakeBlob(self, name)
+
+
+@pytest.fixture
+def processor():
+    with mock.patch('google.cloud.storage.Client'), mock.patch('clients.ClientRegistry.ensure_initialized'):
+        from municipal_processor import MunicipalDocumentProcessor
+        processor = MunicipalDocumentProcessor(bucket_name='test-bucket')
+    processor.bucket = FakeBucket()
+    return processor
+
+
+def test_concurrent_runs_only_record_their_own_pdfs(processor):
+    processor.bucket.add('pdfs/a_minutes_2023.pdf', make_pdf())
+    processor.bucket.add('pdfs/broken.pdf', b'not a pdf')
+    run_a = processor.process_directory('pdfs/', workers=1)
+    processor.bucket.add('pdfs/b_bylaw_2024.pdf', make_pdf())
+    run_b = processor.process_directory('pdfs/', workers=1)
+
+    assert [blob.name for blob in run_a.errors] == ['pdfs/broken.pdf']
+    # Run A finishes first; run B's PDFs must stay pending until B records them
+    processor.record_ingested(run_a)
+    run_c = processor.process_directory('pdfs/', workers=1)
+    assert run_c.skipped == ['pdfs/a_minutes_2023.pdf']
+    assert sorted(blob.name for blob in run_c.parsed + list(run_c.errors)) == \
+        ['pdfs/b_bylaw_2024.pdf', 'pdfs/broken.pdf']
+
+    processor.record_ingested(run_b)
+    run_d = processor.process_directory('pdfs/', workers=1)
+    assert run_d.skipped == ['pdfs/a_minutes_2023.pdf', 'pdfs/b_bylaw_2024.pdf']
+    assert [blob.name for blob in run_d.errors] == ['pdfs/broken.pdf']
+
+
+def test_baseline_skips_existing_pdfs_on_the_first_run(processor):
+    processor.bucket.add('pdfs/a_minutes_2023.pdf', make_pdf())
+    assert processor.record_baseline('pdfs/') == ['pdfs/a_minutes_2023.pdf']
+    processor.bucket.add('pdfs/b_bylaw_2024.pdf', make_pdf())
+
+    run = processor.process_directory('pdfs/', workers=1)
+    assert run.skipped == ['pdfs/a_minutes_2023.pdf']
+    assert [blob.name for blob in run.parsed] == ['pdfs/b_bylaw_2024.pdf']
+
+
+def test_first_embedding_run_seeds_pdfs_with_current_outputs():
+    import createuploadembeddings
+    from manifest import IngestionManifest
+
+    source, target = FakeBucket(), FakeBucket()
+    for name in ('pdfs/embedded.pdf', 'pdfs/replaced.pdf', 'pdfs/new.pdf'):
+        source.add(name, make_pdf())
+    for name in ('embedded_embeddings.json', 'replaced_embeddings.json'):
+        target.add(name, b'{}')
+    source.blobs['pdfs/embedded.pdf'].updated = datetime(2024, 1, 1)
+    target.blobs['embedded_embeddings.json'].updated = datetime(2024, 1, 2)
+    source.blobs['pdfs/replaced.pdf'].updated = datetime(2024, 1, 3)
+    target.blobs['replaced_embeddings.json'].updated = datetime(2024, 1, 2)
+    source.blobs['pdfs/new.pdf'].updated = datetime(2024, 1, 1)
+
+    manifest = IngestionManifest(source, 'manifest.json').load()
+    pdfs = source.list_blobs()
+    with mock.patch.object(createuploadembeddings.storage, 'Client') as client:
+        client.return_value.list_blobs.return_value = target.list_blobs()
+        seeded = createuploadembeddings.seed_from_outputs(manifest, pdfs, 'target')
+        assert [blob.name for blob in seeded] == ['pdfs/embedded.pdf']
+        pending, skipped = manifest.partition(pdfs)
+        assert [blob.name for blob in pending] == ['pdfs/new.pdf', 'pdfs/replaced.pdf']
+        # Only an empty manifest is seeded
+        assert createuploadembeddings.seed_from_outputs(manifest, pdfs, 'target') == []
@@ -0,0 +1,23 @@
+import os
+
+from parallel import map_files
+import process_municipal_docs
+
+
+def test_failed_pdf_is_reported(tmp_path, monkeypatch):
+    input_dir = tmp_path / 'data' / 'municipal_docs'
+    input_dir.mkdir(parents=True)
+    (input_dir / 'broken.pdf').write_bytes(b'not a pdf')
+    monkeypatch.chdir(tmp_path)
+
+    process_municipal_docs.main(workers=1)
+
+    summary = (tmp_path / 'data' / 'processed' / '_summary.json').read_text()
+    assert '"failed_documents": [\n    "broken.pdf"\n  ]' in summary
+    assert not os.path.exists(tmp_path / 'data' / 'processed' / 'broken.pdf.json')
+
+
+def test_map_files_keys_results_and_errors():
+    results, errors = map_files(int, {'one': ('1',), 'bad': ('x',), 'two': ('2',)}, workers=1)
+    assert results == {'one': 1, 'two': 2}
+    assert list(errors) == ['bad']
@@ -0,0 +1,51 @@
+import importlib
+import sys
+from types import SimpleNamespace
+from unittest import mock
+
+import pytest
+
+
+@pytest.fixture
+def offline_clients():
+    """Stand-ins for GCS and Vertex AI so modules can be constructed without credentials."""
+    with mock.patch('google.cloud.storage.Client') as storage_client, \
+            mock.patch('clients.ClientRegistry.ensure_initialized'):
+        yield storage_client
+
+
+def test_processor_constructs(offline_clients):
+    from municipal_processor import MunicipalDocumentProcessor
+
+    processor = MunicipalDocumentProcessor(bucket_name='test-bucket')
+    assert processor.bucket is offline_clients.return_value.bucket.return_value
+
+
+def test_main_imports(offline_clients):
+    sys.modules.pop('main', None)
+    main = importlib.import_module('main')
+    assert main.app.url_map.bind('').match('/process-documents', method='POST')
+
+
+def test_query_searches_deployed_endpoint(offline_clients):
+    sys.modules.pop('main', None)
+    main = importlib.import_module('main')
+    endpoint = mock.Mock()
+    endpoint.find_neighbors.return_value = [[SimpleNamespace(id='minutes-2023-4', distance=0.25)]]
+    with mock.patch('clients.ClientRegistry.index_endpoint', return_value=endpoint) as index_endpoint, \
+            mock.patch.object(main.embedding_gen, 'generate_embeddings', return_value=[[0.1, 0.2]]):
+        client = main.app.test_client()
+        filtered = client.post('/query', json={'query': 'zoning', 'filters': {'year': 2023}})
+        unfiltered = client.post('/query', json={'query': 'zoning'})
+
+    assert filtered.status_code == 200
+    assert filtered.get_json()['results'] == [{'id': 'minutes-2023-4', 'score': 0.25}]
+    assert filtered.get_json()['filters'] == {'year': ['2023']}
+    index_endpoint.assert_called_with(main.INDEX_ENDPOINT_NAME)
+    filtered_call, unfiltered_call = endpoint.find_neighbors.call_args_list
+    assert filtered_call.kwargs['deployed_index_id'] == main.DEPLOYED_INDEX_ID
+    assert filtered_call.kwargs['queries'] == [[0.1, 0.2]]
+    assert [(namespace.name, namespace.allow_tokens) for namespace in filtered_call.kwargs['filter']] == \
+        [('year', ['2023'])]
+    assert unfiltered.status_code == 200
+    assert unfiltered_call.kwargs['filter'] is None
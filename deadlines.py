@@ -0,0 +1,187 @@
+# Copyright 2024 Google LLC
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#  https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import asyncio
+import logging
+import threading
+import contextvars
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Optional
+
+import numpy as np
+from prometheus_client import Counter
+
+logger = logging.getLogger(__name__)
+
+DEADLINES_EXCEEDED = Counter('deadline_exceeded_total', 'Requests that ran out of time, by stage', ['stage'])
+
+
+class DeadlineExceeded(Exception):
+    """Raised when a request runs out of its time budget."""
+
+    def __init__(self, stage: str):
+        super().__init__(f"Deadline exceeded during {stage}")
+        self.stage = stage
+
+
+class Deadline:
+    """Absolute point in time by which a request must be answered."""
+
+    def __init__(self, timeout: float):
+        self.expires_at = time.monotonic() + timeout if timeout > 0 else float('inf')
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+
+_current: "contextvars.ContextVar[Optional[Deadline]]" = contextvars.ContextVar('deadline', default=None)
+
+
+@contextmanager
+def deadline_scope(timeout: float):
+    """Give the code in this block (thread or asyncio task) an overall deadline."""
+    token = _current.set(Deadline(timeout))
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+def set_deadline(timeout: float):
+    """Set the deadline for the rest of the current context, e.g. inside an async generator
+    whose steps may not all run in the context that entered a deadline_scope."""
+    _current.set(Deadline(timeout))
+
+
+def stage_timeout(stage: str, cap: float = 0) -> Optional[float]:
+    """Time a stage may take: the rest of the request deadline, at most cap seconds.
+
+    Returns None when neither limits it; raises DeadlineExceeded if no time is left.
+    """
+    deadline = _current.get()
+    limit = cap if cap > 0 else float('inf')
+    if deadline is not None:
+        limit = min(limit, deadline.remaining())
+    if limit <= 0:
+        DEADLINES_EXCEEDED.labels(stage).inc()
+        raise DeadlineExceeded(stage)
+    return None if limit == float('inf') else limit
+
+
+def wait_result(future: Future, stage: str, cap: float = 0) -> Any:
+    """Wait for a future within the stage's share of the deadline."""
+    try:
+        return future.result(timeout=stage_timeout(stage, cap))
+    except FutureTimeoutError:
+        DEADLINES_EXCEEDED.labels(stage).inc()
+        raise DeadlineExceeded(stage) from None
+
+
+async def wait_async(awaitable, stage: str, cap: float = 0) -> Any:
+    """Await a coroutine or future within the stage's share of the deadline."""
+    if isinstance(awaitable, Future):
+        awaitable = asyncio.wrap_future(awaitable)
+    try:
+        return await asyncio.wait_for(awaitable, timeout=stage_timeout(stage, cap))
+    except asyncio.TimeoutError:
+        DEADLINES_EXCEEDED.labels(stage).inc()
+        raise DeadlineExceeded(stage) from None
+
+
+class Hedger:
+    """Run a remote call and send a duplicate once it is slower than its recent p95 latency.
+
+    Whichever call succeeds first wins. The hedge delay is the given quantile of the
+    last window successful call latencies, and hedging starts after min_samples calls.
+    Waiting stops after timeout seconds (0 = no limit); a call that is still running
+    keeps its worker thread until the remote side returns.
+    """
+
+    def __init__(self, name: str, timeout: float = 0, quantile: float = 0.95, min_samples: int = 20,
+                 window: int = 200, max_workers: int = 16, enabled: bool = True):
+        self.name = name
+        self.timeout = timeout
+        self.quantile = quantile
+        self.min_samples = min_samples
+        self.enabled = enabled
+        self._latencies: "deque[float]" = deque(maxlen=window)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"{name}-hedger")
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.hedges_sent = 0
+        self.hedges_won = 0
+        self.timeouts = 0
+
+    def hedge_delay(self) -> Optional[float]:
+        with self._lock:
+            if not self.enabled or len(self._latencies) < self.min_samples:
+                return None
+            return float(np.quantile(self._latencies, self.quantile))
+
+    def _timed(self, fn: Callable, args) -> Any:
+        started = time.monotonic()
+        result = fn(*args)
+        with self._lock:
+            self._latencies.append(time.monotonic() - started)
+        return result
+
+    def call(self, fn: Callable, *args) -> Any:
+        started = time.monotonic()
+        with self._lock:
+            self.calls += 1
+
+        def remaining():
+            return None if self.timeout <= 0 else max(0.0, self.timeout - (time.monotonic() - started))
+
+        primary = self._executor.submit(self._timed, fn, args)
+        pending = {primary}
+        delay = self.hedge_delay()
+        if delay is not None:
+            budget = remaining()
+            done, _ = wait(pending, timeout=delay if budget is None else min(delay, budget))
+            if not done and (budget is None or budget > delay):
+                pending.add(self._executor.submit(self._timed, fn, args))
+                with self._lock:
+                    self.hedges_sent += 1
+
+        error = None
+        while pending:
+            done, pending = wait(pending, timeout=remaining(), return_when=FIRST_COMPLETED)
+            if not done:
+                with self._lock:
+                    self.timeouts += 1
+                DEADLINES_EXCEEDED.labels(self.name).inc()
+                raise DeadlineExceeded(self.name)
+            for future in done:
+                if future.exception() is None:
+                    if future is not primary:
+                        with self._lock:
+                            self.hedges_won += 1
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def stats(self) -> Dict:
+        delay = self.hedge_delay()
+        with self._lock:
+            return {
+                'calls': self.calls,
+                'hedges_sent': self.hedges_sent,
+                'hedges_won': self.hedges_won,
+                'timeouts': self.timeouts,
+                'hedge_delay': delay if delay is not None else 0.0
+            }
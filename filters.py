@@ -0,0 +1,117 @@
+# Copyright 2024 Google LLC
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#  https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This module is mirrored in data-ingestion/filters.py because the serving app
+# and the ingestion service are built as separate container images.
+
+import json
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+# Metadata fields datapoints can be filtered on; they become Vector Search restrict namespaces
+FILTER_FIELDS = ('document_type', 'year', 'municipality')
+
+Filters = Dict[str, Tuple[str, ...]]
+
+
+def filter_values(metadata: Dict) -> Dict[str, str]:
+    """Normalized filter values of a record or chunk metadata.
+
+    The two ingestion pipelines disagree on names and types (`doc_type` vs `document_type`,
+    int vs str years), so every value is compared as a lowercase string.
+    """
+    raw = {
+        'document_type': metadata.get('document_type') or metadata.get('doc_type'),
+        'year': metadata.get('year'),
+        'municipality': metadata.get('municipality')
+    }
+    return {field: str(value).strip().lower() for field, value in raw.items()
+            if value is not None and str(value).strip()}
+
+
+def to_restricts(metadata: Dict) -> List[Dict]:
+    """Vector Search `restricts` entries for a datapoint with the given metadata."""
+    return [{'namespace': field, 'allow': [value]} for field, value in filter_values(metadata).items()]
+
+
+def parse_filters(raw: Optional[Dict]) -> Filters:
+    """Validate request filters of the form {field: value or [values]}.
+
+    Values of one field are alternatives; different fields must all match.
+    Raises ValueError for unknown fields or empty values.
+    """
+    if not raw:
+        return {}
+    if not isinstance(raw, dict):
+        raise ValueError("filters must be an object")
+    filters = {}
+    for field, values in raw.items():
+        if field not in FILTER_FIELDS:
+            raise ValueError(f"Unknown filter field: {field}. Supported: {', '.join(FILTER_FIELDS)}")
+        if not isinstance(values, list):
+            values = [values]
+        normalized = tuple(sorted({str(value).strip().lower() for value in values
+                                   if value is not None and str(value).strip()}))
+        if not normalized:
+            raise ValueError(f"Filter {field} has no values")
+        filters[field] = normalized
+    return filters
+
+
+def filter_key(filters: Filters) -> str:
+    """Canonical string for a set of filters, '' when unfiltered."""
+    return json.dumps(sorted(filters.items())) if filters else ''
+
+
+def to_namespaces(filters: Filters) -> List:
+    """Vector Search query namespaces for the given filters."""
+    from google.cloud.aiplatform.matching_engine.matching_engine_index_endpoint import Namespace
+
+    return [Namespace(field, list(values), []) for field, values in filters.items()]
+
+
+class FilterIndex:
+    """Per-field posting lists (value -> sorted record offsets) over a list of records.
+
+    A filtered search intersects the lists of the requested values, so it only has to
+    scan the matching subset instead of the whole corpus.
+    """
+
+    def __init__(self, records: Iterable[Dict] = ()):
+        postings = defaultdict(lambda: defaultdict(list))
+        for offset, record in enumerate(records):
+            for field, value in filter_values(record).items():
+                postings[field][value].append(offset)
+        self._postings = {field: {value: np.asarray(offsets, dtype='int64')
+                                  for value, offsets in values.items()}
+                          for field, values in postings.items()}
+
+    def offsets(self, filters: Filters) -> Optional[np.ndarray]:
+        """Sorted offsets of the records matching every filter, or None when unfiltered."""
+        if not filters:
+            return None
+        matched = None
+        for field, values in filters.items():
+            lists = [self._postings.get(field, {}).get(value) for value in values]
+            lists = [offsets for offsets in lists if offsets is not None]
+            field_offsets = np.unique(np.concatenate(lists)) if lists else np.zeros(0, dtype='int64')
+            matched = field_offsets if matched is None else np.intersect1d(matched, field_offsets,
+                                                                           assume_unique=True)
+            if not len(matched):
+                break
+        return matched
+
+    def stats(self) -> Dict:
+        return {field: len(values) for field, values in self._postings.items()}
@@ -0,0 +1,137 @@
+# Copyright 2024 Google LLC
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#  https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import re
+import math
+import time
+import logging
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+from corpus import TEXT_FIELDS, record_text
+from filters import FILTER_FIELDS, FilterIndex, Filters
+
+logger = logging.getLogger(__name__)
+
+# Keeps identifiers such as "2023-045", "4.2.1" or "bq/v2" together as one token
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[.\-/][a-z0-9]+)*")
+STOPWORDS = frozenset("a an and are as at be by for from has in is it of on or that the this to was were with".split())
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase word tokens; compound identifiers are kept whole and also split into parts."""
+    tokens = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        if token in STOPWORDS:
+            continue
+        tokens.append(token)
+        if not token.isalnum():
+            tokens.extend(part for part in re.split(r"[.\-/]", token) if part and part not in STOPWORDS)
+    return tokens
+
+
+class BM25Index:
+    """Compact in-memory inverted index with Okapi BM25 scoring.
+
+    Each term maps to two parallel numpy arrays (record offsets and term frequencies),
+    so the index costs a few bytes per posting rather than a Python object each.
+    """
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        # (postings, idf, length_norm, ids, filter_index) are swapped together on rebuild
+        self._state = ({}, {}, np.zeros(0, dtype='float32'), [], FilterIndex())
+
+    def build(self, corpus):
+        """Index the text of every record of a corpus, replacing the previous index.
+
+        Reads only the text and filter fields, and keeps the corpus ID column for results.
+        """
+        started = time.monotonic()
+        doc_terms = defaultdict(list)
+        doc_tfs = defaultdict(list)
+        count = len(corpus.records)
+        lengths = np.zeros(count, dtype='float32')
+        for offset, record in enumerate(corpus.select(TEXT_FIELDS)):
+            counts = Counter(tokenize(record_text(record)))
+            lengths[offset] = sum(counts.values())
+            for term, tf in counts.items():
+                doc_terms[term].append(offset)
+                doc_tfs[term].append(tf)
+
+        postings = {term: (np.asarray(offsets, dtype='uint32'), np.asarray(doc_tfs[term], dtype='float32'))
+                    for term, offsets in doc_terms.items()}
+        idf = {term: math.log(1 + (count - len(offsets) + 0.5) / (len(offsets) + 0.5))
+               for term, offsets in doc_terms.items()}
+        avg_length = float(lengths.mean()) if count else 0.0
+        # Per-record part of the BM25 denominator, precomputed once
+        length_norm = self.k1 * (1 - self.b + self.b * lengths / (avg_length or 1.0))
+        ids = corpus.column('id')
+
+        self._state = (postings, idf, length_norm.astype('float32'), ids,
+                       FilterIndex(corpus.select(FILTER_FIELDS)))
+        logger.info(f"Built BM25 index over {count} records and {len(postings)} terms "
+                    f"in {time.monotonic() - started:.1f}s")
+        return self
+
+    def search(self, query: str, k: int = 10, filters: Optional[Filters] = None) -> List[str]:
+        """Return the IDs of the k best matching records, best first."""
+        postings, idf, length_norm, ids, filter_index = self._state
+        offsets, scores = [], []
+        for term in set(tokenize(query)):
+            if term not in postings:
+                continue
+            term_offsets, tfs = postings[term]
+            offsets.append(term_offsets)
+            scores.append(idf[term] * tfs * (self.k1 + 1) / (tfs + length_norm[term_offsets]))
+        if not offsets:
+            return []
+
+        offsets = np.concatenate(offsets)
+        scores = np.concatenate(scores)
+        allowed = filter_index.offsets(filters)
+        if allowed is not None:
+            keep = np.isin(offsets, allowed, assume_unique=False)
+            offsets, scores = offsets[keep], scores[keep]
+            if not len(offsets):
+                return []
+        # Sum the per-term contributions of each record
+        order = np.argsort(offsets, kind='stable')
+        offsets, scores = offsets[order], scores[order]
+        starts = np.flatnonzero(np.r_[True, offsets[1:] != offsets[:-1]])
+        unique_offsets, totals = offsets[starts], np.add.reduceat(scores, starts)
+
+        k = min(k, len(totals))
+        best = np.argpartition(-totals, k - 1)[:k]
+        best = best[np.argsort(-totals[best], kind='stable')]
+        return [ids[unique_offsets[i]] for i in best]
+
+    def stats(self) -> Dict:
+        postings, _, _, ids, _ = self._state
+        return {
+            'records': len(ids),
+            'terms': len(postings),
+            'postings': sum(len(offsets) for offsets, _ in postings.values())
+        }
+
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence[str]], k: int = 60, top_k: int = 10) -> List[str]:
+    """Fuse several ranked ID lists: each ID scores the sum of 1 / (k + rank) over the lists."""
+    scores: Dict[str, float] = defaultdict(float)
+    for ranking in rankings:
+        for rank, id in enumerate(dict.fromkeys(ranking), start=1):
+            scores[id] += 1.0 / (k + rank)
+    return sorted(scores, key=lambda id: -scores[id])[:top_k]
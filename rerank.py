@@ -0,0 +1,70 @@
+# Copyright 2024 Google LLC
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#  https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+
+def _unit_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def mmr(query: Sequence[float], candidates: np.ndarray, k: int, lambda_mult: float = 0.5) -> List[int]:
+    """Maximal Marginal Relevance selection of k candidate rows.
+
+    Each pick maximizes lambda_mult * sim(query, c) - (1 - lambda_mult) * max sim(c, picked).
+    All similarities come from two matrix products up front; each pick then only
+    updates a vector of per-candidate maxima.
+    """
+    if not len(candidates) or k <= 0:
+        return []
+    vectors = _unit_rows(np.asarray(candidates, dtype='float32'))
+    query = _unit_rows(np.asarray(query, dtype='float32'))
+    relevance = vectors @ query
+    similarity = vectors @ vectors.T
+
+    available = np.ones(len(vectors), dtype=bool)
+    redundancy = np.zeros(len(vectors), dtype='float32')
+    selected = []
+    for _ in range(min(k, len(vectors))):
+        scores = lambda_mult * relevance - (1.0 - lambda_mult) * redundancy
+        scores[~available] = -np.inf
+        pick = int(np.argmax(scores))
+        selected.append(pick)
+        available[pick] = False
+        redundancy = similarity[pick] if len(selected) == 1 else np.maximum(redundancy, similarity[pick])
+    return selected
+
+
+def mmr_rerank(query: Sequence[float], ids: List[str], embeddings: Optional[np.ndarray],
+               embedded: Optional[np.ndarray], id_index: Dict[str, int], k: int,
+               lambda_mult: float = 0.5) -> List[str]:
+    """Re-rank candidate record IDs with MMR over their rows of the corpus embedding matrix.
+
+    embedded marks the rows that hold an embedding. Candidates without one follow the
+    MMR picks in their original order.
+    """
+    ids = list(dict.fromkeys(ids))
+    with_vectors, offsets, others = [], [], []
+    for id in ids:
+        offset = id_index.get(id)
+        if offset is not None and embeddings is not None and embedded[offset]:
+            with_vectors.append(id)
+            offsets.append(offset)
+        else:
+            others.append(id)
+    picked = [with_vectors[i] for i in mmr(query, embeddings[offsets], k, lambda_mult)] if offsets else []
+    return (picked + others)[:k]
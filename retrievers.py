@@ -0,0 +1,256 @@
+# Copyright 2024 Google LLC
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#  https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import json
+import logging
+from collections import namedtuple
+from itertools import compress
+from typing import List, Optional
+
+import numpy as np
+
+from filters import FILTER_FIELDS, FilterIndex, Filters, to_namespaces
+
+logger = logging.getLogger(__name__)
+
+# Mirrors the id/distance attributes of the Vector Search MatchNeighbor results
+Neighbor = namedtuple('Neighbor', ['id', 'distance'])
+
+
+class Retriever:
+    """Nearest-neighbor lookup over the corpus embeddings."""
+
+    def find_neighbors(self, queries: List[List[float]], num_neighbors: int = 10,
+                       filters: Optional[Filters] = None) -> List[List[Neighbor]]:
+        """Return one ranked list of neighbors per query vector, restricted to records
+        matching filters (see filters.parse_filters) when given."""
+        raise NotImplementedError
+
+
+class VertexRetriever(Retriever):
+    """Query a deployed Vertex AI Vector Search index."""
+
+    def __init__(self, clients, index_endpoint_name: str, deployed_index_id: str = "bqrelease_index"):
+        self.clients = clients
+        self.index_endpoint_name = index_endpoint_name
+        self.deployed_index_id = deployed_index_id
+
+    def find_neighbors(self, queries, num_neighbors=10, filters=None):
+        index_ep = self.clients.index_endpoint(self.index_endpoint_name)
+        # Filters match the restricts attached to each datapoint at ingestion time
+        return index_ep.find_neighbors(
+            deployed_index_id=self.deployed_index_id,
+            queries=queries,
+            num_neighbors=num_neighbors,
+            filter=to_namespaces(filters) if filters else None
+        )
+
+
+class FaissRetriever(Retriever):
+    """In-process FAISS index built from the `embedding` field of the loaded corpus."""
+
+    def __init__(self, index_type: str = 'flat', nlist: int = 1024, nprobe: int = 16,
+                 index_path: Optional[str] = None):
+        if index_type not in ('flat', 'ivf'):
+            raise ValueError(f"Unsupported FAISS index type: {index_type}")
+        self.index_type = index_type
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.index_path = index_path
+        # (index, corpus offset of each vector, corpus ID column, filter_index) are swapped
+        # together so readers never see a mismatched set; concurrent searches on a CPU index
+        # are safe in faiss
+        self._state = (None, np.zeros(0, dtype='int64'), [], FilterIndex())
+
+    def _build_index(self, vectors: np.ndarray):
+        import faiss
+
+        dim = vectors.shape[1]
+        if self.index_type == 'flat':
+            index = faiss.IndexFlatIP(dim)
+        else:
+            # IVF needs at least one training point per list
+            nlist = max(1, min(self.nlist, len(vectors) // 39 or 1))
+            quantizer = faiss.IndexFlatIP(dim)
+            index = faiss.IndexIVFFlat(quantizer, dim, nlist, faiss.METRIC_INNER_PRODUCT)
+            index.train(vectors)
+            index.nprobe = min(self.nprobe, nlist)
+        index.add(vectors)
+        if self.index_type == 'ivf':
+            # Filtered searches reconstruct the vectors of the matching subset by offset
+            index.make_direct_map()
+        return index
+
+    def build(self, corpus):
+        """Build (or load from index_path) the index over the embedded records of a corpus."""
+        import faiss
+
+        if corpus.embeddings is None:
+            raise ValueError("Corpus has no embeddings to index")
+        rows = np.flatnonzero(corpus.embedded)
+        ids = corpus.column('id')
+        # Filter offsets are positions in the index, i.e. among the records with an embedding
+        filter_index = FilterIndex(compress(corpus.select(FILTER_FIELDS), corpus.embedded))
+        if self.index_path and self._load(rows, ids, filter_index):
+            return self
+
+        # Indexing by rows copies them, so normalizing in place leaves the corpus matrix alone
+        vectors = np.ascontiguousarray(corpus.embeddings[rows], dtype='float32')
+        if not len(vectors):
+            raise ValueError("Corpus has no embeddings to index")
+        # Cosine similarity via inner product on unit vectors
+        faiss.normalize_L2(vectors)
+        index = self._build_index(vectors)
+        self._state = (index, rows, ids, filter_index)
+        logger.info(f"Built FAISS {self.index_type} index over {len(rows)} vectors")
+
+        if self.index_path:
+            self.save(self.index_path)
+        return self
+
+    def save(self, index_path: str):
+        """Persist the index and its ID table next to each other."""
+        import faiss
+
+        index, rows, ids, _ = self._state
+        faiss.write_index(index, index_path)
+        with open(f"{index_path}.ids.json", 'w') as ids_file:
+            json.dump({'index_type': self.index_type, 'ids': [ids[offset] for offset in rows]}, ids_file)
+        logger.info(f"Saved FAISS index to {index_path}")
+
+    def _load(self, rows: np.ndarray, ids, filter_index: FilterIndex) -> bool:
+        """Load a persisted index if it was built from exactly the IDs at these offsets."""
+        import faiss
+
+        ids_path = f"{self.index_path}.ids.json"
+        if not (os.path.exists(self.index_path) and os.path.exists(ids_path)):
+            return False
+        try:
+            with open(ids_path) as ids_file:
+                saved = json.load(ids_file)
+            if saved.get('index_type') != self.index_type or saved.get('ids') != [ids[offset] for offset in rows]:
+                logger.info("Persisted FAISS index is stale, rebuilding")
+                return False
+            index = faiss.read_index(self.index_path)
+        except Exception as e:
+            logger.warning(f"Could not load FAISS index from {self.index_path}: {str(e)}")
+            return False
+        if self.index_type == 'ivf':
+            index.nprobe = self.nprobe
+            index.make_direct_map()
+        self._state = (index, rows, ids, filter_index)
+        logger.info(f"Loaded FAISS index from {self.index_path}")
+        return True
+
+    def find_neighbors(self, queries, num_neighbors=10, filters=None):
+        import faiss
+
+        index, rows, ids, filter_index = self._state
+        if index is None:
+            raise RuntimeError("FAISS index has not been built")
+        # A copy, normalized in place without touching the caller's vectors
+        vectors = np.array(queries, dtype='float32')
+        faiss.normalize_L2(vectors)
+        if filters:
+            return self._search_subset(index, rows, ids, filter_index.offsets(filters), vectors, num_neighbors)
+        scores, offsets = index.search(vectors, num_neighbors)
+        return [
+            [Neighbor(ids[rows[offset]], 1.0 - float(score))
+             for score, offset in zip(row_scores, row_offsets) if offset >= 0]
+            for row_scores, row_offsets in zip(scores, offsets)
+        ]
+
+    @staticmethod
+    def _search_subset(index, rows, ids, subset, vectors, num_neighbors):
+        """Exact search over the vectors at the given offsets only."""
+        if not len(subset):
+            return [[] for _ in vectors]
+        scores = vectors @ index.reconstruct_batch(subset).T
+        best = _top_k(scores, num_neighbors)
+        return [
+            [Neighbor(ids[rows[subset[column]]], 1.0 - float(row_scores[column])) for column in row_best]
+            for row_scores, row_best in zip(scores, best)
+        ]
+
+
+class ExactRetriever(Retriever):
+    """Exact cosine scan over the corpus embedding matrix, with numpy.
+
+    The matrix is read in place (memory-mapped for a shared corpus); only the row
+    norms are kept next to it. Used as the local fallback when the remote index is
+    unavailable.
+    """
+
+    def __init__(self):
+        # (embeddings, norms, rows without an embedding, ids, filter_index) are swapped
+        # together on rebuild
+        self._state = (np.zeros((0, 0), dtype='float32'), np.zeros(0, dtype='float32'),
+                       np.zeros(0, dtype='int64'), [], FilterIndex())
+
+    def build(self, corpus):
+        count = len(corpus.records)
+        embeddings, embedded = corpus.embeddings, corpus.embedded
+        if embeddings is None:
+            embeddings, embedded = np.zeros((count, 0), dtype='float32'), np.zeros(count, dtype=bool)
+        # Row by row, without a squared copy of the matrix
+        norms = np.sqrt(np.einsum('ij,ij->i', embeddings, embeddings))
+        norms[norms == 0] = 1.0
+        missing = np.flatnonzero(~np.asarray(embedded))
+        self._state = (embeddings, norms, missing, corpus.column('id'), FilterIndex(corpus.select(FILTER_FIELDS)))
+        logger.info(f"Built exact fallback index over {count - len(missing)} vectors")
+        return self
+
+    def find_neighbors(self, queries, num_neighbors=10, filters=None):
+        embeddings, norms, missing, ids, filter_index = self._state
+        queries = np.asarray(queries, dtype='float32')
+        if len(missing) == len(ids):
+            return [[] for _ in queries]
+        query_norms = np.linalg.norm(queries, axis=1, keepdims=True)
+        query_norms[query_norms == 0] = 1.0
+        queries = queries / query_norms
+        subset = filter_index.offsets(filters)
+        if subset is None:
+            scores = queries @ embeddings.T / norms
+            scores[:, missing] = -np.inf
+        else:
+            subset = np.setdiff1d(subset, missing, assume_unique=True)
+            if not len(subset):
+                return [[] for _ in queries]
+            scores = queries @ embeddings[subset].T / norms[subset]
+        best = _top_k(scores, num_neighbors)
+        offsets = subset if subset is not None else range(len(ids))
+        return [
+            [Neighbor(ids[offsets[column]], 1.0 - float(row_scores[column]))
+             for column in row_best if np.isfinite(row_scores[column])]
+            for row_scores, row_best in zip(scores, best)
+        ]
+
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Column indices of the k highest scores of each row, best first."""
+    k = min(k, scores.shape[1])
+    best = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(scores, best, axis=1), axis=1, kind='stable')
+    return np.take_along_axis(best, order, axis=1)
+
+
+def create_retriever(backend: str, clients=None, index_endpoint_name: Optional[str] = None,
+                     deployed_index_id: str = "bqrelease_index", index_type: str = 'flat',
+                     nlist: int = 1024, nprobe: int = 16, index_path: Optional[str] = None) -> Retriever:
+    """Create the retriever selected by configuration."""
+    if backend == 'vertex':
+        return VertexRetriever(clients, index_endpoint_name, deployed_index_id)
+    if backend == 'faiss':
+        return FaissRetriever(index_type=index_type, nlist=nlist, nprobe=nprobe, index_path=index_path)
+    raise ValueError(f"Unknown retriever backend: {backend}")
@@ -0,0 +1,183 @@
+# Copyright 2024 Google LLC
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#  https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import logging
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class ChatSession:
+    """Conversation state for one session: recent turns, a summary of older ones and fetched context."""
+
+    def __init__(self, session_id: str):
+        self.session_id = session_id
+        self.summary = ''
+        self.turns: List[Tuple[str, str]] = []
+        # Context record IDs fetched by earlier turns, most recent first
+        self.context_ids: List[str] = []
+        self.last_query: Optional[np.ndarray] = None
+        self.last_used = time.time()
+        self.lock = threading.Lock()
+        # Set while older turns are being summarized outside the lock
+        self.compacting = False
+
+    def history_text(self) -> str:
+        """Render the summary and recent turns for the prompt."""
+        parts = []
+        if self.summary:
+            parts.append(f"Summary of earlier conversation: {self.summary}")
+        for question, answer in self.turns:
+            parts.append(f"User: {question}\nAssistant: {answer}")
+        return "\n".join(parts)
+
+
+class SessionStore:
+    """Bounded LRU store of chat sessions that keeps each history within a token budget.
+
+    Once a session's summary and turns exceed history_tokens, the oldest turns are
+    folded into the summary with summarize(summary, turns). If that call fails the
+    turns are folded in as truncated text instead.
+    """
+
+    def __init__(self, count_tokens: Callable[[str], int],
+                 summarize: Optional[Callable[[str, List[Tuple[str, str]]], str]] = None,
+                 max_sessions: int = 1000, ttl: float = 1800, history_tokens: int = 1000,
+                 max_context_ids: int = 30, reuse_distance: float = 0.1):
+        self.count_tokens = count_tokens
+        self.summarize = summarize
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.history_tokens = history_tokens
+        self.max_context_ids = max_context_ids
+        self.reuse_distance = reuse_distance
+        self._sessions: "OrderedDict[str, ChatSession]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.created = 0
+        self.evictions = 0
+        self.compactions = 0
+        self.context_reuses = 0
+
+    def get(self, session_id: str) -> ChatSession:
+        """Return the session for session_id, creating it if needed."""
+        now = time.time()
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is not None and self.ttl > 0 and now - session.last_used > self.ttl:
+                del self._sessions[session_id]
+                session = None
+            if session is None:
+                session = ChatSession(session_id)
+                self._sessions[session_id] = session
+                self.created += 1
+                while len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+                    self.evictions += 1
+            self._sessions.move_to_end(session_id)
+            session.last_used = now
+            return session
+
+    def reusable_context(self, session: ChatSession, query_vector: List[float]) -> Optional[List[str]]:
+        """Return the context IDs fetched earlier in the session if the new question is
+        within reuse_distance (cosine) of the previous one, so retrieval can be skipped."""
+        with session.lock:
+            last_query, context_ids = session.last_query, list(session.context_ids)
+        if last_query is None or not context_ids:
+            return None
+        query = np.asarray(query_vector, dtype='float32')
+        norm = np.linalg.norm(query) * np.linalg.norm(last_query)
+        if not norm or 1.0 - float(query @ last_query) / norm > self.reuse_distance:
+            return None
+        with self._lock:
+            self.context_reuses += 1
+        return context_ids
+
+    def record_turn(self, session: ChatSession, question: str, answer: str,
+                    context_ids: List[str], query_vector: Optional[List[float]]):
+        """Append a turn, remember its context and compact the history if it is over budget.
+
+        query_vector is None when the question could not be embedded; the previous
+        query then stays the reference for context reuse.
+        """
+        with session.lock:
+            session.turns.append((question, answer))
+            merged = list(dict.fromkeys(list(context_ids) + session.context_ids))
+            session.context_ids = merged[:self.max_context_ids]
+            if query_vector is not None:
+                session.last_query = np.asarray(query_vector, dtype='float32')
+            older = self._start_compaction(session)
+        if older:
+            self._compact(session, older)
+
+    def _history_tokens(self, session: ChatSession) -> int:
+        return self.count_tokens(session.history_text())
+
+    def _start_compaction(self, session: ChatSession) -> List[Tuple[str, str]]:
+        """With session.lock held: return the turns to fold into the summary, if any."""
+        if session.compacting or self._history_tokens(session) <= self.history_tokens:
+            return []
+        # Keep the latest turn verbatim and fold everything older into the summary
+        older = session.turns[:-1]
+        if older:
+            session.compacting = True
+        else:
+            self._truncate_summary(session)
+        return older
+
+    def _compact(self, session: ChatSession, older: List[Tuple[str, str]]):
+        """Fold older turns into the summary. The summarize call runs without the session
+        lock, so other requests on the session are not held up by the model."""
+        try:
+            with session.lock:
+                previous = session.summary
+            summary = None
+            if self.summarize is not None:
+                try:
+                    summary = self.summarize(previous, older)
+                except Exception as e:
+                    logger.warning(f"Session summary failed, truncating history instead: {str(e)}")
+            if not summary:
+                summary = " ".join([previous] + [f"{q} {a}" for q, a in older]).strip()
+            with session.lock:
+                # Only one compaction runs at a time and turns are only appended meanwhile,
+                # so the folded turns are still the oldest ones
+                session.turns = session.turns[len(older):]
+                session.summary = summary
+                self._truncate_summary(session)
+        finally:
+            with session.lock:
+                session.compacting = False
+        with self._lock:
+            self.compactions += 1
+
+    def _truncate_summary(self, session: ChatSession):
+        # The summary may still be too long: keep its most recent part
+        budget_chars = self.history_tokens * 2
+        if self._history_tokens(session) > self.history_tokens and len(session.summary) > budget_chars:
+            session.summary = session.summary[-budget_chars:]
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                'sessions': len(self._sessions),
+                'max_sessions': self.max_sessions,
+                'created': self.created,
+                'evictions': self.evictions,
+                'compactions': self.compactions,
+                'context_reuses': self.context_reuses
+            }
@@ -0,0 +1,316 @@
+# Copyright 2024 Google LLC
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#  https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Corpus snapshots packed into flat numpy files in a directory shared by all worker
+# processes (e.g. /dev/shm). Workers memory-map the files read-only, so N gunicorn
+# workers share one copy of the sentences, IDs and embeddings instead of holding N.
+
+import os
+import json
+import fcntl
+import shutil
+import logging
+from collections.abc import Sequence
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+CURRENT_FILE = 'current.json'
+LOCK_FILE = '.lock'
+
+
+def _encode_strings(values: Iterable[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """(lengths, UTF-8 bytes) of a run of strings, as written by _write_strings."""
+    encoded = [value.encode('utf-8') for value in values]
+    return (np.asarray([len(value) for value in encoded], dtype='int64'),
+            np.frombuffer(b''.join(encoded), dtype='uint8'))
+
+
+def _write_strings(path: str, name: str, parts: List[Tuple[np.ndarray, np.ndarray]]):
+    """Store runs of (lengths, UTF-8 bytes) as one buffer plus an (N + 1) offsets array."""
+    lengths = np.concatenate([part_lengths for part_lengths, _ in parts]) if parts else np.zeros(0, dtype='int64')
+    offsets = np.zeros(len(lengths) + 1, dtype='int64')
+    np.cumsum(lengths, out=offsets[1:])
+    np.save(os.path.join(path, f"{name}.offsets.npy"), offsets)
+    np.save(os.path.join(path, f"{name}.data.npy"),
+            np.concatenate([data for _, data in parts]) if parts else np.zeros(0, dtype='uint8'))
+
+
+class StringColumn:
+    """Read-only view of a string column written by _write_strings."""
+
+    def __init__(self, path: str, name: str):
+        self._offsets = np.load(os.path.join(path, f"{name}.offsets.npy"), mmap_mode='r')
+        self._data = np.load(os.path.join(path, f"{name}.data.npy"), mmap_mode='r')
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, offset: int) -> str:
+        start, end = self._offsets[offset], self._offsets[offset + 1]
+        return self._data[start:end].tobytes().decode('utf-8')
+
+    def encoded(self, start: int, end: int) -> Tuple[np.ndarray, np.ndarray]:
+        """(lengths, UTF-8 bytes) of the strings at offsets start..end, without decoding them."""
+        offsets = self._offsets[start:end + 1]
+        return np.diff(offsets), self._data[offsets[0]:offsets[-1]]
+
+
+class PackedRecords(Sequence):
+    """List-of-dicts view over the string columns of a packed snapshot; each record is
+    decoded on access. Embeddings are not part of the records (see SharedCorpus)."""
+
+    def __init__(self, path: str, fields: Iterable[str], count: int):
+        self.count = count
+        self._columns = {field: StringColumn(path, field) for field in fields if field != 'embedding'}
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, offset):
+        if isinstance(offset, slice):
+            return [self[i] for i in range(*offset.indices(self.count))]
+        if offset < 0:
+            offset += self.count
+        if not 0 <= offset < self.count:
+            raise IndexError(offset)
+        # Empty strings stand for fields the original record did not have
+        record = {}
+        for field, column in self._columns.items():
+            value = column[offset]
+            if value:
+                record[field] = value
+        return record
+
+    def select(self, fields: Iterable[str]) -> Iterator[dict]:
+        """Iterate over the records decoding only the given fields."""
+        columns = [(field, self._columns[field]) for field in fields if field in self._columns]
+        for offset in range(self.count):
+            record = {}
+            for field, column in columns:
+                value = column[offset]
+                if value:
+                    record[field] = value
+            yield record
+
+
+class RecordRange(Sequence):
+    """The records of one blob within a packed snapshot."""
+
+    def __init__(self, records: PackedRecords, start: int, end: int):
+        self.records = records
+        self.start = start
+        self.end = end
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __getitem__(self, offset):
+        if isinstance(offset, slice):
+            return [self[i] for i in range(*offset.indices(len(self)))]
+        if not 0 <= offset < len(self):
+            raise IndexError(offset)
+        return self.records[self.start + offset]
+
+
+class PackedIdIndex:
+    """ID -> record offset lookups by binary search over offsets sorted by ID.
+
+    Like corpus.build_id_index, duplicate IDs resolve to their first offset.
+    """
+
+    def __init__(self, path: str, ids: StringColumn):
+        self._ids = ids
+        self._order = np.load(os.path.join(path, 'id.order.npy'), mmap_mode='r')
+
+    def __len__(self):
+        return len(self._order)
+
+    def get(self, id: str, default: Optional[int] = None) -> Optional[int]:
+        low, high = 0, len(self._order)
+        while low < high:
+            middle = (low + high) // 2
+            if self._ids[int(self._order[middle])] < id:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self._order) and self._ids[int(self._order[low])] == id:
+            return int(self._order[low])
+        return default
+
+    def __contains__(self, id: str) -> bool:
+        return self.get(id) is not None
+
+
+class SharedCorpus:
+    """Corpus snapshot attached read-only from a published directory.
+
+    Exposes the same blobs, generation, records, id_index, embeddings, embedded and
+    loaded_at attributes and column/select methods as corpus.Corpus, so the rest of the
+    serving code does not need to tell them apart. The embedding matrix stays memory-mapped.
+    """
+
+    def __init__(self, path: str):
+        with open(os.path.join(path, 'manifest.json')) as manifest_file:
+            manifest = json.load(manifest_file)
+        self.path = path
+        self.generation = manifest['generation']
+        self.records = PackedRecords(path, manifest['fields'], manifest['count'])
+        self.id_index = PackedIdIndex(path, self.records._columns['id'])
+        self.embeddings, self.embedded = None, None
+        if 'embedding' in manifest['fields']:
+            self.embeddings = np.load(os.path.join(path, 'embedding.npy'), mmap_mode='r')
+            self.embedded = np.load(os.path.join(path, 'embedding.mask.npy'), mmap_mode='r')
+        self.blobs = {name: (generation, RecordRange(self.records, start, end),
+                             self.embeddings[start:end] if self.embeddings is not None else None)
+                      for name, (generation, start, end) in manifest['blobs'].items()}
+        self.loaded_at = datetime.fromisoformat(manifest['loaded_at'])
+
+    def column(self, field: str) -> StringColumn:
+        """The values of one field by record offset ('' where a record has none), memory-mapped."""
+        return self.records._columns[field]
+
+    def select(self, fields: Iterable[str]) -> Iterator[dict]:
+        """The records with only the given fields, decoded one at a time for index builds."""
+        return self.records.select(fields)
+
+
+def _column_part(records, field: str) -> Tuple[np.ndarray, np.ndarray]:
+    """(lengths, UTF-8 bytes) of one field of a blob's records. Records of an attached
+    snapshot are copied from its column as they are, without decoding them."""
+    if isinstance(records, RecordRange) and field in records.records._columns:
+        return records.records._columns[field].encoded(records.start, records.end)
+    return _encode_strings(str(entry[field]) if entry.get(field) is not None else '' for entry in records)
+
+
+class SharedCorpusDirectory:
+    """Publish corpus snapshots to a shared directory and attach to the latest one.
+
+    Each snapshot lives in its own gen-<n> directory and becomes visible when
+    current.json is atomically replaced. Publishing and attaching happen under an
+    exclusive file lock, so only one process downloads and packs a new corpus.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    @contextmanager
+    def lock(self):
+        with open(os.path.join(self.directory, LOCK_FILE), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def latest_generation(self) -> int:
+        try:
+            with open(os.path.join(self.directory, CURRENT_FILE)) as current_file:
+                return json.load(current_file)['generation']
+        except (OSError, ValueError, KeyError):
+            return 0
+
+    def attach_newer(self, generation: int) -> Optional[SharedCorpus]:
+        """Attach to the published snapshot if it is newer than generation."""
+        latest = self.latest_generation()
+        if latest <= generation:
+            return None
+        try:
+            corpus = SharedCorpus(os.path.join(self.directory, f"gen-{latest}"))
+        except (OSError, ValueError, KeyError) as e:
+            # Left for the caller to rebuild; publish() then supersedes the broken snapshot
+            logger.warning(f"Ignoring unreadable shared corpus generation {latest}: {str(e)}")
+            return None
+        logger.info(f"Attached shared corpus generation {latest}: {len(corpus.records)} records")
+        return corpus
+
+    def publish(self, blobs, generation: int, fields: Iterable[str]) -> SharedCorpus:
+        """Pack a corpus, make it the current snapshot and attach to it.
+
+        blobs maps blob name -> (GCS generation, records, embedding matrix or None), as for
+        corpus.Corpus. Blobs carried over from the attached snapshot are copied column by
+        column, so only new and changed blobs are encoded. The snapshot is published as a
+        generation newer than the current one even if generation is not, so workers still
+        attached to an older snapshot pick it up.
+        """
+        fields = tuple(dict.fromkeys(('id',) + tuple(fields)))
+        generation = max(generation, self.latest_generation() + 1)
+        name = f"gen-{generation}"
+        staging = os.path.join(self.directory, f".{name}.{os.getpid()}")
+        shutil.rmtree(staging, ignore_errors=True)
+        os.makedirs(staging)
+
+        names = sorted(blobs)
+        count = sum(len(blobs[blob_name][1]) for blob_name in names)
+        for field in fields:
+            if field == 'embedding':
+                continue
+            _write_strings(staging, field, [_column_part(blobs[blob_name][1], field) for blob_name in names])
+        ids = StringColumn(staging, 'id')
+        np.save(os.path.join(staging, 'id.order.npy'),
+                np.argsort(np.asarray([ids[offset] for offset in range(count)], dtype=object),
+                           kind='stable').astype('int64') if count else np.zeros(0, dtype='int64'))
+        if 'embedding' in fields:
+            dim = max((matrix.shape[1] for _, _, matrix in blobs.values() if matrix is not None), default=0)
+            # Written in place, so the whole matrix is never held in memory
+            matrix_file = np.lib.format.open_memmap(os.path.join(staging, 'embedding.npy'), mode='w+',
+                                                    dtype='float32', shape=(count, dim))
+            mask = np.zeros(count, dtype=bool)
+            start = 0
+            for blob_name in names:
+                _, blob_records, matrix = blobs[blob_name]
+                end = start + len(blob_records)
+                if matrix is not None and matrix.shape[1] == dim:
+                    matrix_file[start:end] = matrix
+                    mask[start:end] = np.asarray(matrix).any(axis=1)
+                start = end
+            matrix_file.flush()
+            del matrix_file
+            np.save(os.path.join(staging, 'embedding.mask.npy'), mask)
+
+        # Record ranges per blob follow Corpus's sorted blob order
+        ranges, start = {}, 0
+        for blob_name in names:
+            blob_generation, blob_records, _ = blobs[blob_name]
+            ranges[blob_name] = (blob_generation, start, start + len(blob_records))
+            start += len(blob_records)
+        with open(os.path.join(staging, 'manifest.json'), 'w') as manifest_file:
+            json.dump({'generation': generation, 'fields': list(fields), 'count': count,
+                       'blobs': ranges, 'loaded_at': datetime.utcnow().isoformat()}, manifest_file)
+
+        target = os.path.join(self.directory, name)
+        shutil.rmtree(target, ignore_errors=True)
+        os.rename(staging, target)
+        current_tmp = os.path.join(self.directory, f".{CURRENT_FILE}.{os.getpid()}")
+        with open(current_tmp, 'w') as current_file:
+            json.dump({'generation': generation}, current_file)
+        os.replace(current_tmp, os.path.join(self.directory, CURRENT_FILE))
+        self._remove_old(name)
+        logger.info(f"Published shared corpus generation {generation} to {target}")
+        return SharedCorpus(target)
+
+    def _remove_old(self, keep: str):
+        # Processes still mapping an old snapshot keep reading it after the files are unlinked.
+        # Staging files of a publish that was interrupted are removed too; publishing holds
+        # the lock, so no other publish is in progress
+        for entry in os.listdir(self.directory):
+            path = os.path.join(self.directory, entry)
+            if (entry.startswith('gen-') or entry.startswith('.gen-')) and entry != keep:
+                shutil.rmtree(path, ignore_errors=True)
+            elif entry.startswith(f".{CURRENT_FILE}."):
+                os.remove(path)
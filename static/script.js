@@ -11,6 +11,12 @@
 // See the License for the specific language governing permissions and
 // limitations under the License.
 
+// One server-side chat session per page load, so follow-up questions keep their context
+const SESSION_ID = (window.crypto && crypto.randomUUID)
+  ? crypto.randomUUID()
+  : Date.now().toString(36) + Math.random().toString(36).slice(2);
+
+
 document.addEventListener("DOMContentLoaded", function () {
   document.getElementById("chat-form").addEventListener("submit", function (event) {
     event.preventDefault(); // Prevent the form from submitting via HTTP
@@ -20,24 +26,9 @@ document.addEventListener("DOMContentLoaded", function () {
 
     if (message) {
       addMessage("user", message);
-      fetch("/ask", {
-        method: "POST",
-        headers: {
-          "Content-Type": "application/json",
-        },
-        body: JSON.stringify({ question: message }),
-      })
-      .then(response => response.json())
-      .then(data => {
-        if (data.response) { // Handle response based on updated Flask app structure
-          addMessage("bot", data.response.replace(/\*\*/g, '')); // Display bot response without asterisks
-        } else {
-          addMessage("bot", "Sorry, I couldn't process that."); // Fallback message
-        }
-      })
-      .catch(error => {
-        console.error("Error:", error);
-        addMessage("bot", "An error occurred."); // Show error message in chat
+      askStream(message).catch(error => {
+        console.error("Streaming failed, falling back to /ask:", error);
+        askOnce(message);
       });
     }
     userInput.value = ""; // Clear input field after sending
@@ -45,6 +36,116 @@ document.addEventListener("DOMContentLoaded", function () {
 });
 
 
+function askOnce(message) {
+  fetch("/ask", {
+    method: "POST",
+    headers: {
+      "Content-Type": "application/json",
+    },
+    body: JSON.stringify({ question: message, session_id: SESSION_ID }),
+  })
+  .then(response => response.json())
+  .then(data => {
+    if (data.response) { // Handle response based on updated Flask app structure
+      addMessage("bot", data.response.replace(/\*\*/g, '')); // Display bot response without asterisks
+    } else {
+      addMessage("bot", "Sorry, I couldn't process that."); // Fallback message
+    }
+  })
+  .catch(error => {
+    console.error("Error:", error);
+    addMessage("bot", "An error occurred."); // Show error message in chat
+  });
+}
+
+
+// Stream the answer from /ask_stream (Server-Sent Events) and render it as it arrives.
+// Rejects before anything is rendered so the caller can fall back to /ask.
+async function askStream(message) {
+  const response = await fetch("/ask_stream", {
+    method: "POST",
+    headers: {
+      "Content-Type": "application/json",
+      "Accept": "text/event-stream",
+    },
+    body: JSON.stringify({ question: message, session_id: SESSION_ID }),
+  });
+  if (!response.ok || !response.body) {
+    throw new Error(`Unexpected response: ${response.status}`);
+  }
+
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = "";
+  let answer = "";
+  let messageDiv = null;
+
+  const render = (text) => {
+    if (!messageDiv) {
+      messageDiv = addMessage("bot", "");
+    }
+    formatMessage(messageDiv, text);
+    const chatBox = document.getElementById("chat-box");
+    chatBox.scrollTop = chatBox.scrollHeight;
+  };
+
+  while (true) {
+    let chunk;
+    try {
+      chunk = await reader.read();
+    } catch (error) {
+      if (!messageDiv) {
+        throw error; // Nothing rendered yet, let the caller fall back to /ask
+      }
+      console.error("Error:", error);
+      render(answer + "\nAn error occurred.");
+      return;
+    }
+    const { value, done } = chunk;
+    if (done) {
+      break;
+    }
+    buffer += decoder.decode(value, { stream: true });
+
+    // Events are separated by a blank line
+    let boundary;
+    while ((boundary = buffer.indexOf("\n\n")) !== -1) {
+      const rawEvent = buffer.slice(0, boundary);
+      buffer = buffer.slice(boundary + 2);
+
+      let eventType = "message";
+      let data = "";
+      rawEvent.split("\n").forEach((line) => {
+        if (line.startsWith("event:")) {
+          eventType = line.slice(6).trim();
+        } else if (line.startsWith("data:")) {
+          data += line.slice(5).trim();
+        }
+      });
+      const payload = data ? JSON.parse(data) : {};
+
+      if (eventType === "error") {
+        render(answer ? answer + "\n" + payload.error : payload.error);
+        return;
+      }
+      if (eventType === "done") {
+        if (!answer) {
+          render("Sorry, I couldn't process that.");
+        }
+        return;
+      }
+      if (payload.text) {
+        answer += payload.text;
+        render(answer);
+      }
+    }
+  }
+  if (!messageDiv) {
+    throw new Error("Stream ended without an answer");
+  }
+}
+
+
 function addMessage(sender, message) {
   let chatBox = document.getElementById("chat-box");
   let containerDiv = document.createElement("div");
@@ -58,7 +159,20 @@ function addMessage(sender, message) {
 
   let messageDiv = document.createElement("div");
   messageDiv.classList.add("message", `${sender}-message`);
+  formatMessage(messageDiv, message);
+
+
+  containerDiv.appendChild(label);
+  containerDiv.appendChild(messageDiv);
+  chatBox.appendChild(containerDiv);
+  chatBox.scrollTop = chatBox.scrollHeight; // Scroll to bottom
+  return messageDiv;
+}
+
 
+// Render message text into messageDiv, replacing what was there before.
+function formatMessage(messageDiv, message) {
+  messageDiv.replaceChildren();
 
   // Handle new lines and bullet points
   const lines = message.split('\n');
@@ -87,11 +201,4 @@ function addMessage(sender, message) {
   } else {
     messageDiv.appendChild(formattedMessage);
   }
-
-
-  containerDiv.appendChild(label);
-  containerDiv.appendChild(messageDiv);
-  chatBox.appendChild(containerDiv);
-  chatBox.scrollTop = chatBox.scrollHeight; // Scroll to bottom
 }
-
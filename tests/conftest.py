@@ -0,0 +1,55 @@
+import io
+import json
+import os
+import sys
+from unittest import mock
+
+import pytest
+
+from corpus import Corpus
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class FakeBlob:
+    """An embeddings JSONL file in the fake bucket."""
+
+    def __init__(self, name, records, generation=1):
+        self.name, self.generation = name, generation
+        self.data = ''.join(json.dumps(record) + '\n' for record in records)
+        self.size = len(self.data.encode())
+        self.reads = 0
+
+    def open(self, mode, chunk_size=None):
+        self.reads += 1
+        return io.StringIO(self.data)
+
+
+class FakeBucket(dict):
+    def add(self, name, records, generation=1):
+        self[name] = FakeBlob(name, records, generation)
+        return self[name]
+
+
+@pytest.fixture
+def bucket():
+    """The bucket corpus.CorpusStore lists and downloads, in place of GCS."""
+    blobs = FakeBucket()
+    with mock.patch('corpus.storage.Client') as client:
+        client.return_value.list_blobs.side_effect = lambda name: list(blobs.values())
+        yield blobs
+
+
+RECORDS = [
+    {'id': 'r1', 'sentence': 'Council approved the parking bylaw amendment', 'document_type': 'bylaw', 'year': '2023'},
+    {'id': 'r2', 'sentence': 'Parking permits are issued by the town hall', 'document_type': 'minutes', 'year': '2022'},
+    {'id': 'r3', 'sentence': 'The budget for road repairs was approved', 'document_type': 'minutes', 'year': '2023'},
+    {'id': 'r4', 'sentence': 'Bylaw 2023-045 sets downtown parking fines and parking zones',
+     'document_type': 'bylaw', 'year': '2024'},
+]
+
+
+@pytest.fixture
+def records():
+    """A small municipal corpus with text and filter fields, without embeddings."""
+    return Corpus({'a.json': (1, RECORDS, None)}, 1)
@@ -0,0 +1,54 @@
+import threading
+
+import pytest
+
+from batching import MicroBatcher
+
+
+def test_concurrent_items_share_one_batch():
+    batches = []
+    batcher = MicroBatcher(lambda items: batches.append(items) or [item * 2 for item in items],
+                           max_batch_size=4, max_wait=0.2)
+    barrier = threading.Barrier(4)
+    results = {}
+
+    def submit(item):
+        barrier.wait()
+        results[item] = batcher.submit(item)
+
+    threads = [threading.Thread(target=submit, args=(item,)) for item in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == {0: 0, 1: 2, 2: 4, 3: 6}
+    assert len(batches) == 1 and sorted(batches[0]) == [0, 1, 2, 3]
+    assert batcher.stats()['avg_batch_size'] == 4
+
+
+def test_batch_failure_reaches_every_item():
+    def fail(items):
+        raise RuntimeError('embedding service down')
+
+    batcher = MicroBatcher(fail, max_batch_size=2, max_wait=0.05)
+    futures = [batcher.submit_future(item) for item in 'ab']
+
+    for future in futures:
+        with pytest.raises(RuntimeError, match='embedding service down'):
+            future.result(timeout=5)
+
+
+def test_wrong_result_count_is_an_error():
+    batcher = MicroBatcher(lambda items: [], max_batch_size=1)
+
+    with pytest.raises(RuntimeError, match='expected 1 results, got 0'):
+        batcher.submit('a')
+
+
+def test_batch_size_one_calls_per_item():
+    batches = []
+    batcher = MicroBatcher(lambda items: batches.append(items) or items, max_batch_size=1)
+
+    assert [batcher.submit(item) for item in 'ab'] == ['a', 'b']
+    assert batches == [['a'], ['b']]
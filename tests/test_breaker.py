@@ -0,0 +1,62 @@
+from unittest import mock
+
+import pytest
+
+from breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpenError
+
+
+def fail():
+    raise RuntimeError('unavailable')
+
+
+def trip(breaker, calls):
+    for _ in range(calls):
+        with pytest.raises(RuntimeError):
+            breaker.call(fail)
+
+
+def test_opens_at_the_failure_rate_and_fails_fast():
+    breaker = CircuitBreaker('embed', failure_rate=0.5, min_calls=4)
+    breaker.call(lambda: 'ok')
+    breaker.call(lambda: 'ok')
+    trip(breaker, 1)
+    assert breaker.state == CLOSED
+    trip(breaker, 1)
+    assert breaker.state == OPEN
+
+    called = mock.Mock()
+    with pytest.raises(CircuitOpenError) as raised:
+        breaker.call(called)
+    called.assert_not_called()
+    assert raised.value.name == 'embed'
+    assert breaker.stats()['rejected'] == 1
+
+
+def test_half_open_probes_close_or_reopen_the_circuit():
+    breaker = CircuitBreaker('embed', min_calls=1, open_seconds=30, half_open_probes=2)
+    with mock.patch('breaker.time.monotonic', return_value=100.0):
+        trip(breaker, 1)
+    with mock.patch('breaker.time.monotonic', return_value=131.0):
+        breaker.call(lambda: 'ok')
+        assert breaker.state == HALF_OPEN
+        trip(breaker, 1)
+        assert breaker.state == OPEN
+    with mock.patch('breaker.time.monotonic', return_value=162.0):
+        breaker.call(lambda: 'ok')
+        breaker.call(lambda: 'ok')
+        assert breaker.state == CLOSED
+    assert breaker.stats()['opened'] == 2
+
+
+def test_slow_calls_count_as_failures():
+    breaker = CircuitBreaker('generate', min_calls=1, slow_call_seconds=5)
+    breaker.record(True, elapsed=6)
+    assert breaker.state == OPEN
+
+
+def test_guard_records_failures_raised_in_the_block():
+    breaker = CircuitBreaker('generate', min_calls=1)
+    with pytest.raises(ValueError):
+        with breaker.guard():
+            raise ValueError('stream broke')
+    assert breaker.state == OPEN
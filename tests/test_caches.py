@@ -0,0 +1,92 @@
+from unittest import mock
+
+from caches import AnswerCache, EmbeddingCache
+
+
+def test_answer_cache_matches_within_scope():
+    cache = AnswerCache(max_size=4, max_distance=0.05)
+    cache.put([1.0, 0.0], 'unfiltered', generation=0)
+    cache.put([1.0, 0.0], 'minutes only', generation=0, scope='minutes')
+
+    assert cache.lookup([1.0, 0.01], generation=0) == 'unfiltered'
+    assert cache.lookup([1.0, 0.01], generation=0, scope='minutes') == 'minutes only'
+    assert cache.lookup([1.0, 0.01], generation=0, scope='bylaws') is None
+    assert cache.lookup([0.0, 1.0], generation=0) is None
+
+
+def test_answer_cache_skips_an_expired_best_match():
+    cache = AnswerCache(max_size=4, max_distance=0.05, ttl=60)
+    with mock.patch('caches.time.time', return_value=1000.0):
+        cache.put([1.0, 0.0], 'stale', generation=0)
+    with mock.patch('caches.time.time', return_value=1050.0):
+        cache.put([1.0, 0.02], 'fresh', generation=0)
+    with mock.patch('caches.time.time', return_value=1070.0):
+        # The stale entry is the closer one, but it expired at 1060
+        assert cache.lookup([1.0, 0.0], generation=0) == 'fresh'
+    assert cache.stats()['size'] == 1
+
+
+def test_answer_cache_evicts_least_recently_used():
+    cache = AnswerCache(max_size=2, max_distance=0.05)
+    cache.put([1.0, 0.0], 'a', generation=0, scope='x')
+    cache.put([0.0, 1.0], 'b', generation=0)
+    assert cache.lookup([1.0, 0.0], generation=0, scope='x') == 'a'
+    cache.put([-1.0, 0.0], 'c', generation=0)
+
+    assert cache.lookup([0.0, 1.0], generation=0) is None
+    assert cache.lookup([1.0, 0.0], generation=0, scope='x') == 'a'
+    assert cache.stats()['evictions'] == 1
+
+
+def test_answer_cache_invalidate_drops_entries_and_late_puts():
+    cache = AnswerCache(max_size=2)
+    cache.put([1.0, 0.0], 'a', generation=0)
+    generation = cache.invalidate()
+
+    assert cache.lookup([1.0, 0.0], generation=generation) is None
+    cache.put([1.0, 0.0], 'late', generation=0)
+    assert cache.stats()['size'] == 0
+
+
+def test_embedding_cache_normalizes_questions_per_model():
+    cache = EmbeddingCache(max_size=4)
+    cache.put('What is  BigQuery?', 'gecko', [1.0])
+
+    assert cache.get('what is bigquery?', 'gecko') == [1.0]
+    assert cache.get('what is bigquery?', 'other-model') is None
+    assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 1
+
+
+def test_embedding_cache_expires_and_evicts():
+    cache = EmbeddingCache(max_size=2, ttl=60)
+    with mock.patch('caches.time.time', return_value=1000.0):
+        cache.put('old', 'gecko', [1.0])
+        cache.put('a', 'gecko', [2.0])
+    with mock.patch('caches.time.time', return_value=1070.0):
+        assert cache.get('old', 'gecko') is None
+        cache.put('b', 'gecko', [3.0])
+        cache.put('c', 'gecko', [4.0])
+        assert cache.stats()['evictions'] == 1
+        assert cache.get('a', 'gecko') is None
+        assert cache.get('b', 'gecko') == [3.0]
+
+
+def test_embedding_cache_disk_tier_survives_a_restart(tmp_path):
+    path = str(tmp_path / 'embeddings.sqlite')
+    EmbeddingCache(path=path).put('question', 'gecko', [0.5, 0.25])
+
+    restarted = EmbeddingCache(path=path)
+    assert restarted.get('question', 'gecko') == [0.5, 0.25]
+    assert restarted.stats()['disk_hits'] == 1
+    # Served from memory from then on
+    assert restarted.get('question', 'gecko') == [0.5, 0.25]
+    assert restarted.stats()['hits'] == 1
+
+
+def test_embedding_cache_computes_once():
+    cache = EmbeddingCache()
+    compute = mock.Mock(return_value=[1.0])
+
+    assert cache.get_or_compute('q', 'gecko', compute) == [1.0]
+    assert cache.get_or_compute('q', 'gecko', compute) == [1.0]
+    compute.assert_called_once_with('q')
@@ -0,0 +1,37 @@
+import pytest
+
+from context_builder import ContextBuilder
+
+
+@pytest.fixture(autouse=True)
+def offline_tokens(monkeypatch):
+    """Count tokens with the ~4 characters per token estimate instead of downloading tiktoken data."""
+    def no_tiktoken(name):
+        raise OSError('offline')
+
+    monkeypatch.setattr('tiktoken.get_encoding', no_tiktoken)
+
+
+def test_drops_exact_and_near_duplicates():
+    builder = ContextBuilder(token_budget=0, dedup_threshold=0.8)
+    context, usage = builder.build([
+        'Council approved the parking bylaw.',
+        'council approved the parking bylaw',
+        'Council approved the new parking bylaw.',
+        ' ',
+        'Road repairs start in May.',
+    ])
+
+    assert context == 'Council approved the parking bylaw.\nRoad repairs start in May.'
+    assert usage['items_used'] == 2 and usage['duplicates_dropped'] == 2
+
+
+def test_skips_sentences_over_the_budget_but_keeps_later_ones_that_fit():
+    builder = ContextBuilder(token_budget=10)
+    # 4, 11 and 3 estimated tokens, each plus a separator
+    context, usage = builder.build(['a' * 16, 'b' * 44, 'c' * 12])
+
+    assert context == 'a' * 16 + '\n' + 'c' * 12
+    assert usage['context_tokens'] == 9
+    assert usage['over_budget_dropped'] == 1
+    assert builder.stats()['avg_context_tokens'] == 9
@@ -0,0 +1,69 @@
+import numpy as np
+from prometheus_client import REGISTRY
+
+from corpus import Corpus, CorpusStore, load_blob_records, lookup_sentences
+
+
+def sample(name):
+    return REGISTRY.get_sample_value(name) or 0
+
+
+def test_load_reports_download_metrics(bucket):
+    blob = bucket.add('a.json', [{'id': 'a1', 'sentence': 'one'}, {'id': 'a2', 'sentence': 'two'}])
+    before = {name: sample(name) for name in ('corpus_download_bytes_total', 'corpus_download_records_total',
+                                              'corpus_download_seconds_count', 'corpus_load_seconds_count')}
+
+    CorpusStore('bucket').get()
+
+    assert sample('corpus_download_bytes_total') - before['corpus_download_bytes_total'] == blob.size
+    assert sample('corpus_download_records_total') - before['corpus_download_records_total'] == 2
+    assert sample('corpus_download_seconds_count') - before['corpus_download_seconds_count'] == 1
+    assert sample('corpus_load_seconds_count') - before['corpus_load_seconds_count'] == 1
+
+
+def test_blob_records_keep_only_the_serving_fields(bucket):
+    blob = bucket.add('a.json', [{'id': 'a1', 'sentence': 'one', 'extra': 'x', 'embedding': [1.0, 2.0]},
+                                 {'id': 'a2', 'text': 'two'}])
+
+    records, embeddings = load_blob_records(blob, ('id', 'sentence', 'text', 'embedding'))
+    assert records == [{'id': 'a1', 'sentence': 'one'}, {'id': 'a2', 'text': 'two'}]
+    assert embeddings.tolist() == [[1.0, 2.0], [0.0, 0.0]]
+    assert load_blob_records(blob)[1] is None
+
+
+def test_corpus_stacks_embeddings_in_blob_order():
+    corpus = Corpus({'b.json': (1, [{'id': 'b1'}], np.asarray([[0.0, 1.0]], dtype='float32')),
+                     'a.json': (1, [{'id': 'a1'}, {'id': 'a2'}], np.asarray([[1.0, 0.0], [0.0, 0.0]], dtype='float32')),
+                     'c.json': (1, [{'id': 'c1'}], np.asarray([[1.0]], dtype='float32'))}, 1)
+
+    assert corpus.column('id') == ['a1', 'a2', 'b1', 'c1']
+    assert corpus.embeddings.tolist() == [[1.0, 0.0], [0.0, 0.0], [0.0, 1.0], [0.0, 0.0]]
+    # a2 has no embedding, c.json's have the wrong dimension
+    assert corpus.embedded.tolist() == [True, False, True, False]
+    assert corpus.blobs['b.json'][2].base is corpus.embeddings
+
+
+def test_lookup_keeps_rank_order_and_skips_unknown_and_repeated_ids(records):
+    assert lookup_sentences(['r3', 'missing', 'r1', 'r3'], records.records, records.id_index) == \
+        ['The budget for road repairs was approved', 'Council approved the parking bylaw amendment']
+
+
+def test_refresh_downloads_only_changed_blobs_and_drops_removed_ones(bucket):
+    blob_a = bucket.add('a.json', [{'id': 'a1', 'sentence': 'one'}])
+    bucket.add('b.json', [{'id': 'b1', 'sentence': 'two'}])
+    store = CorpusStore('bucket')
+    swaps = []
+    store.on_swap(swaps.append)
+    first = store.get()
+    assert not store.refresh()
+
+    del bucket['b.json']
+    bucket.add('c.json', [{'id': 'c1', 'sentence': 'three'}])
+    assert store.refresh()
+
+    corpus = store.get()
+    assert swaps == [corpus] and corpus is not first
+    assert corpus.generation == 2
+    assert corpus.column('id') == ['a1', 'c1']
+    assert blob_a.reads == 1
+    assert first.column('id') == ['a1', 'b1']
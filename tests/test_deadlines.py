@@ -0,0 +1,73 @@
+import threading
+import time
+from concurrent.futures import Future
+
+import pytest
+
+from deadlines import DeadlineExceeded, Hedger, deadline_scope, stage_timeout, wait_result
+
+
+def test_stage_timeout_is_the_rest_of_the_deadline_capped():
+    assert stage_timeout('embed') is None
+    assert stage_timeout('embed', cap=2) == 2
+    with deadline_scope(10):
+        assert 9 < stage_timeout('embed') <= 10
+        assert stage_timeout('embed', cap=2) == 2
+
+
+def test_spent_deadline_raises_with_the_stage():
+    with deadline_scope(0.01):
+        time.sleep(0.02)
+        with pytest.raises(DeadlineExceeded) as raised:
+            stage_timeout('generate')
+    assert raised.value.stage == 'generate'
+
+
+def test_wait_result_stops_waiting_at_the_deadline():
+    with deadline_scope(0.05):
+        with pytest.raises(DeadlineExceeded):
+            wait_result(Future(), 'find_neighbors')
+
+
+def test_hedge_wins_over_a_stalled_call():
+    hedger = Hedger('embed', min_samples=3, quantile=0.5)
+    for _ in range(3):
+        hedger.call(lambda: 'warm-up')
+    release = threading.Event()
+    calls = []
+
+    def remote():
+        calls.append(1)
+        if len(calls) == 1:
+            # The first call stalls until the test ends
+            release.wait(5)
+            return 'slow'
+        return 'fast'
+
+    try:
+        assert hedger.call(remote) == 'fast'
+    finally:
+        release.set()
+    stats = hedger.stats()
+    assert stats['hedges_sent'] == 1 and stats['hedges_won'] == 1
+
+
+def test_hedger_times_out():
+    hedger = Hedger('find_neighbors', timeout=0.05)
+    release = threading.Event()
+    try:
+        with pytest.raises(DeadlineExceeded):
+            hedger.call(release.wait, 5)
+    finally:
+        release.set()
+    assert hedger.stats()['timeouts'] == 1
+
+
+def test_hedger_raises_when_every_call_fails():
+    hedger = Hedger('embed', enabled=False)
+
+    def fail():
+        raise RuntimeError('quota exceeded')
+
+    with pytest.raises(RuntimeError, match='quota exceeded'):
+        hedger.call(fail)
@@ -0,0 +1,45 @@
+import pytest
+
+from filters import FilterIndex, filter_key, filter_values, parse_filters, to_restricts
+
+
+def test_parse_filters_normalizes_values():
+    assert parse_filters(None) == {}
+    assert parse_filters({'year': [2023, '2022', 2023], 'document_type': ' Minutes '}) == \
+        {'year': ('2022', '2023'), 'document_type': ('minutes',)}
+
+
+@pytest.mark.parametrize('raw, message', [
+    (['minutes'], 'must be an object'),
+    ({'author': 'mayor'}, 'Unknown filter field'),
+    ({'year': [None, ' ']}, 'has no values'),
+])
+def test_parse_filters_rejects_invalid_filters(raw, message):
+    with pytest.raises(ValueError, match=message):
+        parse_filters(raw)
+
+
+def test_filter_values_accept_both_ingestion_schemas():
+    assert filter_values({'doc_type': 'Bylaw', 'year': 2023}) == {'document_type': 'bylaw', 'year': '2023'}
+    assert to_restricts({'document_type': 'minutes', 'municipality': ''}) == \
+        [{'namespace': 'document_type', 'allow': ['minutes']}]
+
+
+def test_filter_key_is_canonical():
+    assert filter_key({}) == ''
+    assert filter_key({'year': ('2023',), 'document_type': ('minutes',)}) == \
+        filter_key({'document_type': ('minutes',), 'year': ('2023',)})
+
+
+def test_filter_index_intersects_fields_and_unions_values():
+    index = FilterIndex([
+        {'document_type': 'minutes', 'year': '2022'},
+        {'document_type': 'bylaw', 'year': '2023'},
+        {'document_type': 'minutes', 'year': '2023'},
+        {},
+    ])
+
+    assert index.offsets({}) is None
+    assert index.offsets({'document_type': ('minutes',)}).tolist() == [0, 2]
+    assert index.offsets({'document_type': ('minutes', 'bylaw'), 'year': ('2023',)}).tolist() == [1, 2]
+    assert index.offsets({'municipality': ('esquimalt',)}).tolist() == []
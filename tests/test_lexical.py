@@ -0,0 +1,44 @@
+from lexical import BM25Index, reciprocal_rank_fusion, tokenize
+from shared_corpus import SharedCorpusDirectory
+
+
+def test_tokenize_keeps_identifiers_whole_and_drops_stopwords():
+    assert tokenize('The Bylaw 2023-045 in bq/v2') == ['bylaw', '2023-045', '2023', '045', 'bq/v2', 'bq', 'v2']
+
+
+def test_bm25_ranks_shorter_records_with_more_query_terms_first(records):
+    index = BM25Index().build(records)
+
+    assert index.search('parking bylaw') == ['r1', 'r4', 'r2']
+    assert index.search('parking bylaw', k=1) == ['r1']
+    assert index.search('2023-045') == ['r4']
+    assert index.search('zoning') == []
+
+
+def test_bm25_search_is_restricted_to_the_filters(records):
+    index = BM25Index().build(records)
+
+    assert index.search('parking bylaw', filters={'year': ('2023',)}) == ['r1']
+    assert index.search('parking', filters={'document_type': ('minutes',)}) == ['r2']
+    assert index.search('parking', filters={'document_type': ('bylaw',), 'year': ('2022',)}) == []
+
+
+def test_bm25_over_a_shared_snapshot_matches_the_in_memory_corpus(records, tmp_path):
+    shared = SharedCorpusDirectory(str(tmp_path))
+    with shared.lock():
+        snapshot = shared.publish(records.blobs, 1,
+                                  ('id', 'sentence', 'document_type', 'year'))
+    index = BM25Index().build(snapshot)
+
+    assert index.search('parking bylaw') == ['r1', 'r4', 'r2']
+    assert index.search('parking bylaw', filters={'year': ('2023',)}) == ['r1']
+
+
+def test_reciprocal_rank_fusion_favours_ids_ranked_by_both_lists():
+    vector = ['v1', 'shared', 'v2']
+    lexical = ['shared', 'l1', 'v1']
+
+    assert reciprocal_rank_fusion([vector, lexical], k=60) == ['shared', 'v1', 'l1', 'v2']
+    assert reciprocal_rank_fusion([vector, lexical], k=60, top_k=2) == ['shared', 'v1']
+    # Repeats within one list only count at their best rank
+    assert reciprocal_rank_fusion([['a', 'b', 'a'], ['b']], k=60) == ['b', 'a']
@@ -0,0 +1,59 @@
+import time
+
+from flask import Flask, Response, stream_with_context
+
+from prometheus_client import REGISTRY
+
+from metrics import REQUEST_LATENCY, REQUESTS_IN_FLIGHT, register_stats, track_request, tracked_stream
+
+
+def observed(endpoint):
+    return REQUEST_LATENCY.labels(endpoint)._sum.get(), REQUESTS_IN_FLIGHT.labels(endpoint)._value.get()
+
+
+def test_streamed_response_latency_covers_the_stream():
+    app = Flask(__name__)
+
+    @app.route('/stream')
+    @track_request('/test_stream')
+    def stream():
+        def body():
+            yield 'a'
+            time.sleep(0.2)
+            yield 'b'
+        return Response(stream_with_context(tracked_stream(body())))
+
+    before, _ = observed('/test_stream')
+    response = app.test_client().get('/stream')
+    assert response.get_data(as_text=True) == 'ab'
+    latency, in_flight = observed('/test_stream')
+    assert latency - before >= 0.2
+    assert in_flight == 0
+
+
+def test_plain_response_is_finished_by_the_view():
+    app = Flask(__name__)
+
+    @app.route('/plain')
+    @track_request('/test_plain')
+    def plain():
+        return 'ok'
+
+    app.test_client().get('/plain')
+    assert observed('/test_plain')[1] == 0
+    assert REQUEST_LATENCY.labels('/test_plain')._sum.get() > 0
+
+
+def test_registering_stats_does_not_collect_them():
+    calls = []
+
+    def stats():
+        calls.append(1)
+        return {'size': 3}
+
+    collector = register_stats('test_lazy', stats)
+    try:
+        assert calls == []
+        assert [sample.value for metric in collector.collect() for sample in metric.samples] == [3]
+    finally:
+        REGISTRY.unregister(collector)
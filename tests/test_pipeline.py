@@ -0,0 +1,83 @@
+import pytest
+
+import pipeline
+from caches import AnswerCache
+from context_builder import ContextBuilder
+from lexical import BM25Index
+
+
+@pytest.fixture
+def lexical(records, monkeypatch):
+    """A BM25 index over the test corpus, with a fresh answer cache and offline token counts."""
+    def no_tiktoken(name):
+        raise OSError('offline')
+
+    index = BM25Index().build(records)
+    monkeypatch.setattr('tiktoken.get_encoding', no_tiktoken)
+    monkeypatch.setattr(pipeline, 'get_lexical_index', lambda: index)
+    monkeypatch.setattr(pipeline, 'answer_cache', AnswerCache())
+    monkeypatch.setattr(pipeline, 'context_builder', ContextBuilder())
+    monkeypatch.setattr(pipeline, 'MMR_ENABLED', False)
+    monkeypatch.setattr(pipeline, 'FALLBACK_RETRIEVER', 'lexical')
+    return index
+
+
+class Neighbor:
+    def __init__(self, id):
+        self.id = id
+
+
+def prepare(corpus, question, neighbors=None, error=None, embed_error=None, filters=None):
+    """Drive prompt_steps like prepare_prompt, answering its neighbor query with neighbors or error."""
+    steps = pipeline.prompt_steps(question, corpus, None if embed_error else [1.0, 0.0],
+                                  embed_error, filters=filters, generation=pipeline.answer_cache.generation)
+    query, prepared = pipeline.advance(steps)
+    if query is not None:
+        query, prepared = pipeline.advance(steps, [Neighbor(id) for id in neighbors or []], error)
+    assert query is None
+    return prepared
+
+
+def test_hybrid_mode_fuses_vector_and_lexical_rankings(records, lexical, monkeypatch):
+    monkeypatch.setattr(pipeline, 'RETRIEVAL_MODE', 'hybrid')
+
+    # Lexical ranking is r1, r4, r2; r1 is ranked by both lists
+    assert pipeline.select_context_ids('parking bylaw', None, ['r3', 'r1'], records) == ['r1', 'r3', 'r4', 'r2']
+    assert pipeline.select_context_ids('parking bylaw', None, ['r3', 'r1'], records,
+                                       {'year': ('2023',)}) == ['r1', 'r3']
+
+
+def test_vector_mode_keeps_the_neighbor_order(records, lexical, monkeypatch):
+    monkeypatch.setattr(pipeline, 'RETRIEVAL_MODE', 'vector')
+
+    prepared = prepare(records, 'parking bylaw', neighbors=['r3', 'r1'])
+    assert prepared.context_ids == ['r3', 'r1']
+    assert prepared.cacheable
+
+
+def test_failed_neighbor_lookup_falls_back_to_lexical_search(records, lexical, monkeypatch):
+    monkeypatch.setattr(pipeline, 'RETRIEVAL_MODE', 'vector')
+
+    prepared = prepare(records, 'parking bylaw', error=RuntimeError('Vector Search unavailable'))
+    assert prepared.context_ids == ['r1', 'r4', 'r2']
+    assert 'Council approved the parking bylaw amendment' in prepared.full_prompt
+    # Answers built from fallback context are not cached
+    assert not prepared.cacheable
+
+    filtered = prepare(records, 'parking bylaw', error=RuntimeError('Vector Search unavailable'),
+                       filters={'year': ('2023',)})
+    assert filtered.context_ids == ['r1']
+
+
+def test_failed_embedding_falls_back_without_a_neighbor_query(records, lexical):
+    prepared = prepare(records, 'parking', embed_error=RuntimeError('embedding unavailable'),
+                       filters={'document_type': ('minutes',)})
+    assert prepared.context_ids == ['r2']
+    assert not prepared.cacheable
+
+
+def test_failure_is_raised_without_a_fallback(records, lexical, monkeypatch):
+    monkeypatch.setattr(pipeline, 'FALLBACK_RETRIEVER', 'none')
+
+    with pytest.raises(RuntimeError, match='Vector Search unavailable'):
+        prepare(records, 'parking bylaw', error=RuntimeError('Vector Search unavailable'))
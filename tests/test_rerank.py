@@ -0,0 +1,22 @@
+import numpy as np
+
+from rerank import mmr, mmr_rerank
+
+
+def test_mmr_trades_relevance_for_diversity():
+    candidates = np.asarray([[1.0, 0.0], [0.99, 0.05], [0.7, 0.7]], dtype='float32')
+
+    assert mmr([1.0, 0.0], candidates, k=2, lambda_mult=1.0) == [0, 1]
+    # The near duplicate of the first pick loses to the different third candidate
+    assert mmr([1.0, 0.0], candidates, k=2, lambda_mult=0.3) == [0, 2]
+    assert mmr([1.0, 0.0], candidates, k=0) == []
+
+
+def test_mmr_rerank_keeps_candidates_without_embeddings_last():
+    embeddings = np.asarray([[1.0, 0.0], [0.99, 0.05], [0.0, 0.0], [0.7, 0.7]], dtype='float32')
+    embedded = embeddings.any(axis=1)
+    id_index = {'a': 0, 'a2': 1, 'none': 2, 'c': 3}
+
+    assert mmr_rerank([1.0, 0.0], ['none', 'a', 'a2', 'unknown', 'c', 'a'], embeddings, embedded,
+                      id_index, k=5, lambda_mult=0.3) == ['a', 'c', 'a2', 'none', 'unknown']
+    assert mmr_rerank([1.0, 0.0], ['b', 'a'], None, None, {}, k=2) == ['b', 'a']
@@ -0,0 +1,68 @@
+import json
+from unittest import mock
+
+import numpy as np
+import pytest
+
+from corpus import Corpus
+from retrievers import ExactRetriever, FaissRetriever
+
+RECORDS = [
+    {'id': 'east', 'document_type': 'minutes', 'year': '2023'},
+    {'id': 'north', 'document_type': 'bylaw', 'year': '2023'},
+    {'id': 'no-vector', 'document_type': 'minutes', 'year': '2023'},
+    {'id': 'north-east', 'document_type': 'minutes', 'year': '2022'},
+]
+EMBEDDINGS = np.asarray([[1.0, 0.0], [0.0, 1.0], [0.0, 0.0], [0.7, 0.7]], dtype='float32')
+
+
+@pytest.fixture
+def corpus():
+    return Corpus({'a.json': (1, RECORDS, EMBEDDINGS)}, 1)
+
+
+def ids(results):
+    return [[neighbor.id for neighbor in neighbors] for neighbors in results]
+
+
+@pytest.fixture(params=['exact', 'faiss-flat', 'faiss-ivf'])
+def retriever(request, corpus):
+    if request.param == 'exact':
+        return ExactRetriever().build(corpus)
+    pytest.importorskip('faiss')
+    return FaissRetriever(index_type=request.param.split('-')[1]).build(corpus)
+
+
+def test_neighbors_are_ranked_by_cosine_distance(retriever):
+    results = retriever.find_neighbors([[2.0, 0.1], [0.0, 3.0]], num_neighbors=2)
+
+    assert ids(results) == [['east', 'north-east'], ['north', 'north-east']]
+    assert results[0][0].distance == pytest.approx(1 - 2.0 / np.hypot(2.0, 0.1), abs=1e-5)
+
+
+def test_records_without_an_embedding_are_never_returned(retriever):
+    assert ids(retriever.find_neighbors([[1.0, 0.0]], num_neighbors=10)) == [['east', 'north-east', 'north']]
+
+
+def test_filters_restrict_the_neighbors(retriever):
+    assert ids(retriever.find_neighbors([[0.0, 1.0]], 10, {'document_type': ('minutes',)})) == \
+        [['north-east', 'east']]
+    assert ids(retriever.find_neighbors([[0.0, 1.0]], 10, {'year': ('2023',), 'document_type': ('minutes',)})) == \
+        [['east']]
+    assert ids(retriever.find_neighbors([[0.0, 1.0]], 10, {'year': ('1999',)})) == [[]]
+
+
+def test_persisted_faiss_index_is_reused_only_while_the_ids_match(corpus, tmp_path):
+    pytest.importorskip('faiss')
+    path = str(tmp_path / 'index.faiss')
+    FaissRetriever(index_path=path).build(corpus)
+
+    with mock.patch.object(FaissRetriever, '_build_index', side_effect=AssertionError('rebuilt')):
+        reloaded = FaissRetriever(index_path=path).build(corpus)
+    assert ids(reloaded.find_neighbors([[0.0, 1.0]], 1)) == [['north']]
+
+    changed = Corpus({'a.json': (1, RECORDS[:2], EMBEDDINGS[:2])}, 2)
+    rebuilt = FaissRetriever(index_path=path).build(changed)
+    assert ids(rebuilt.find_neighbors([[0.0, 1.0]], 10)) == [['north', 'east']]
+    with open(f"{path}.ids.json") as ids_file:
+        assert json.load(ids_file)['ids'] == ['east', 'north']
@@ -0,0 +1,85 @@
+import threading
+from unittest import mock
+
+from sessions import SessionStore
+
+
+def count_words(text):
+    return len(text.split())
+
+
+def test_sessions_are_evicted_least_recently_used_and_expire():
+    store = SessionStore(count_words, max_sessions=2, ttl=60)
+    with mock.patch('sessions.time.time', return_value=1000.0):
+        first = store.get('a')
+        store.get('b')
+        assert store.get('a') is first
+        store.get('c')
+        assert store.stats()['evictions'] == 1
+        assert store.get('a') is first
+    with mock.patch('sessions.time.time', return_value=1061.0):
+        assert store.get('a') is not first
+
+
+def test_close_follow_up_reuses_the_session_context():
+    store = SessionStore(count_words, reuse_distance=0.1)
+    session = store.get('s')
+    assert store.reusable_context(session, [1.0, 0.0]) is None
+    store.record_turn(session, 'q1', 'a1', ['r1', 'r2'], [1.0, 0.0])
+    store.record_turn(session, 'q2', 'a2', ['r3', 'r1'], None)
+
+    assert session.context_ids == ['r3', 'r1', 'r2']
+    assert store.reusable_context(session, [1.0, 0.05]) == ['r3', 'r1', 'r2']
+    assert store.reusable_context(session, [0.0, 1.0]) is None
+    assert store.stats()['context_reuses'] == 1
+
+
+def test_history_over_budget_is_summarized_keeping_the_latest_turn():
+    summarize = mock.Mock(return_value='talked about parking')
+    store = SessionStore(count_words, summarize=summarize, history_tokens=12)
+    session = store.get('s')
+    store.record_turn(session, 'parking permits?', 'issued at town hall', [], None)
+    store.record_turn(session, 'fines?', 'fifty dollars per ticket downtown', [], None)
+
+    summarize.assert_called_once_with('', [('parking permits?', 'issued at town hall')])
+    assert session.summary == 'talked about parking'
+    assert session.turns == [('fines?', 'fifty dollars per ticket downtown')]
+    assert store.stats()['compactions'] == 1
+
+
+def test_failed_summary_falls_back_to_the_turn_text():
+    def fail(summary, turns):
+        raise RuntimeError('model unavailable')
+
+    store = SessionStore(count_words, summarize=fail, history_tokens=12)
+    session = store.get('s')
+    store.record_turn(session, 'parking permits?', 'issued at town hall', [], None)
+    store.record_turn(session, 'fines?', 'fifty dollars per ticket downtown', [], None)
+
+    # Folded in as text, then cut to the most recent history_tokens * 2 characters
+    assert session.summary == 'parking permits? issued at town hall'[-24:]
+    assert not session.compacting
+
+
+def test_turns_can_be_recorded_while_a_summary_is_generated():
+    started, release = threading.Event(), threading.Event()
+
+    def slow_summary(summary, turns):
+        started.set()
+        release.wait(5)
+        return 'summary'
+
+    store = SessionStore(count_words, summarize=slow_summary, history_tokens=5)
+    session = store.get('s')
+    store.record_turn(session, 'one two three', 'four five six', [], None)
+    compaction = threading.Thread(target=store.record_turn,
+                                  args=(session, 'seven eight', 'nine ten', [], None))
+    compaction.start()
+    assert started.wait(5)
+    # The session lock is free while the model runs
+    store.record_turn(session, 'eleven', 'twelve', [], None)
+    release.set()
+    compaction.join(5)
+
+    assert session.summary == 'summary'
+    assert session.turns == [('seven eight', 'nine ten'), ('eleven', 'twelve')]
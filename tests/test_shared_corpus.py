@@ -0,0 +1,118 @@
+import os
+import threading
+
+import numpy as np
+
+from corpus import CorpusStore
+from shared_corpus import SharedCorpusDirectory
+
+FIELDS = ('id', 'sentence', 'embedding')
+
+
+def blob(generation, *records):
+    """A corpus.Corpus blob entry: records with 2-d embeddings taken from their IDs."""
+    matrix = np.asarray([[float(len(record['id'])), 1.0] for record in records], dtype='float32')
+    return generation, list(records), matrix
+
+
+def snapshots(directory):
+    return sorted(entry for entry in os.listdir(directory) if entry.startswith(('gen-', '.gen-')))
+
+
+def test_published_snapshot_matches_its_blobs(tmp_path):
+    shared = SharedCorpusDirectory(str(tmp_path))
+    with shared.lock():
+        corpus = shared.publish({'b.json': blob(1, {'id': 'b1', 'sentence': 'bee'}),
+                                 'a.json': blob(1, {'id': 'a1', 'sentence': 'ay'}, {'id': 'a22'})},
+                                1, FIELDS)
+
+    # Another worker attaches to it
+    attached = SharedCorpusDirectory(str(tmp_path)).attach_newer(0)
+    for snapshot in (corpus, attached):
+        assert snapshot.generation == 1
+        assert list(snapshot.records) == [{'id': 'a1', 'sentence': 'ay'}, {'id': 'a22'}, {'id': 'b1', 'sentence': 'bee'}]
+        assert snapshot.id_index.get('b1') == 2 and 'zz' not in snapshot.id_index
+        assert snapshot.embeddings[:, 0].tolist() == [2.0, 3.0, 2.0]
+        assert list(snapshot.blobs['b.json'][1]) == [{'id': 'b1', 'sentence': 'bee'}]
+    assert SharedCorpusDirectory(str(tmp_path)).attach_newer(1) is None
+
+
+def test_republish_while_attached_keeps_the_old_snapshot_readable(tmp_path):
+    shared = SharedCorpusDirectory(str(tmp_path))
+    with shared.lock():
+        first = shared.publish({'a.json': blob(1, {'id': 'a1', 'sentence': 'old'})}, 1, FIELDS)
+    reader = SharedCorpusDirectory(str(tmp_path)).attach_newer(0)
+
+    # a.json is carried over from the attached snapshot, b.json is new
+    with shared.lock():
+        second = shared.publish({'a.json': first.blobs['a.json'],
+                                 'b.json': blob(1, {'id': 'b1', 'sentence': 'new'})}, 2, FIELDS)
+
+    assert snapshots(tmp_path) == ['gen-2']
+    assert list(reader.records) == [{'id': 'a1', 'sentence': 'old'}]
+    assert reader.embeddings[0].tolist() == [2.0, 1.0]
+    assert reader.id_index.get('a1') == 0
+    assert list(second.records) == [{'id': 'a1', 'sentence': 'old'}, {'id': 'b1', 'sentence': 'new'}]
+    assert second.embeddings.tolist() == [[2.0, 1.0], [2.0, 1.0]]
+    assert SharedCorpusDirectory(str(tmp_path)).attach_newer(reader.generation).generation == 2
+
+
+def test_concurrent_publishes_are_serialized(tmp_path):
+    def publish(n):
+        shared = SharedCorpusDirectory(str(tmp_path))
+        with shared.lock():
+            generation = shared.latest_generation() + 1
+            shared.publish({'a.json': blob(generation, {'id': f"a{n}"})}, generation, FIELDS)
+
+    threads = [threading.Thread(target=publish, args=(n,)) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    shared = SharedCorpusDirectory(str(tmp_path))
+    assert shared.latest_generation() == 4
+    assert snapshots(tmp_path) == ['gen-4']
+    assert len(shared.attach_newer(0).records) == 1
+
+
+def test_unreadable_snapshot_is_rebuilt_as_a_newer_generation(tmp_path):
+    shared = SharedCorpusDirectory(str(tmp_path))
+    with shared.lock():
+        shared.publish({'a.json': blob(1, {'id': 'a1'})}, 1, FIELDS)
+    os.remove(tmp_path / 'gen-1' / 'manifest.json')
+    # A publish that died while packing left its staging directory behind
+    os.makedirs(tmp_path / '.gen-2.99999')
+
+    assert shared.attach_newer(0) is None
+    with shared.lock():
+        rebuilt = shared.publish({'a.json': blob(1, {'id': 'a1'})}, 1, FIELDS)
+
+    assert rebuilt.generation == 2
+    assert snapshots(tmp_path) == ['gen-2']
+    assert shared.attach_newer(1).generation == 2
+
+
+def test_corrupt_current_pointer_is_treated_as_unpublished(tmp_path):
+    (tmp_path / 'current.json').write_text('{"generation": ')
+    shared = SharedCorpusDirectory(str(tmp_path))
+    assert shared.latest_generation() == 0
+    assert shared.attach_newer(0) is None
+
+
+def test_second_worker_attaches_instead_of_downloading(bucket, tmp_path):
+    blob_a = bucket.add('a.json', [{'id': 'a1', 'sentence': 'one', 'embedding': [1.0, 0.0]}])
+    first = CorpusStore('bucket', fields=FIELDS, shared_dir=str(tmp_path))
+    second = CorpusStore('bucket', fields=FIELDS, shared_dir=str(tmp_path))
+
+    assert list(first.get().records) == [{'id': 'a1', 'sentence': 'one'}]
+    assert list(second.get().records) == [{'id': 'a1', 'sentence': 'one'}]
+    assert blob_a.reads == 1
+
+    # The worker that refreshes first publishes; the other one attaches
+    bucket.add('b.json', [{'id': 'b1', 'sentence': 'two', 'embedding': [0.0, 1.0]}])
+    assert second.refresh()
+    assert first.refresh()
+    assert first.get().generation == second.get().generation == 2
+    assert first.get().embeddings.tolist() == [[1.0, 0.0], [0.0, 1.0]]
+    assert blob_a.reads == 1 and bucket['b.json'].reads == 1